@@ -16,7 +16,9 @@ CONFIGS_COLLECTION = "tafsiri_configs"
 
 mongo_db = client[settings.DATABASE_NAME]
 TafsiriResp = mongo_db.tafsiri_responses
-# TafsiriResp.create_index([("created_at", pymongo.ASCENDING)], unique=False)
+TafsiriRespArchive = mongo_db.tafsiri_responses_archive
+TafsiriRespRollups = mongo_db.tafsiri_response_rollups
+TafsiriJobs = mongo_db.tafsiri_jobs
 
 # MSSQL Connections
 DB_PASSWORD = settings.REPORTING_PASSWORD
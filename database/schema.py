@@ -11,6 +11,7 @@ class TafsiriResponsesBaseSchema(BaseModel):
     time_taken_mms: float
     created_at: datetime = datetime.now()
     created_by: Optional[str] = None
+    config_id: Optional[str] = None
     is_valid: bool = True
 
     class Config:
@@ -1,8 +1,57 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from routes import tafsiri_api, config_api, tafsiriV2_api
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from routes import tafsiri_api, config_api, tafsiriV2_api, jobs_api, analytics_api, exports_api
+from services.analytics import analytics_maintenance_loop
+from services.exports import export_cleanup_loop
+from services.config_cache import start_config_cache, get_cached_configs
+from services.jobs import start_job_heartbeat
+from services.limits import OverloadedError, limiters
+from services.warmup import warmup_state, run_warmup, ping_mongo, prefill_sql_pool, load_warmup_questions
+
+
+def load_context_steps():
+    return [("v1_dictionary", tafsiri_api.warm_up)] + [
+        (f"config:{config['_id']}", partial(tafsiriV2_api.warm_up_config, config))
+        for config in get_cached_configs()
+    ]
+
+
+def load_question_steps():
+    return [
+        (f"question:{index}", partial(tafsiriV2_api.replay_question, item["config_id"], item["question"]))
+        for index, item in enumerate(load_warmup_questions())
+    ]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    analytics_task = asyncio.create_task(analytics_maintenance_loop())
+    export_cleanup_task = asyncio.create_task(export_cleanup_loop())
+    # Connect and warm up in the background so readiness can be polled meanwhile, and
+    # the backends are retried when they are not reachable at startup
+    warmup_task = asyncio.create_task(run_warmup(
+        connection_steps=[
+            ("mongo", ping_mongo),
+            ("config_cache", start_config_cache),
+            ("job_heartbeat", start_job_heartbeat),
+            ("sql_pool", prefill_sql_pool),
+        ],
+        load_context_steps=load_context_steps,
+        load_question_steps=load_question_steps,
+    ))
+    yield
+    warmup_task.cancel()
+    analytics_task.cancel()
+    export_cleanup_task.cancel()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "*",
@@ -21,6 +70,10 @@ app.include_router(tafsiri_api.router, tags=[
 app.include_router(config_api.router, tags=['Config'], prefix='/api/config')
 app.include_router(tafsiriV2_api.router, tags=[
                    'TafsiriV2'], prefix='/api/tafsiri')
+app.include_router(jobs_api.router, tags=['Jobs'], prefix='/api/jobs')
+app.include_router(analytics_api.router, tags=[
+                   'Analytics'], prefix='/api/analytics')
+app.include_router(exports_api.router, tags=['Exports'], prefix='/api/exports')
 
 
 @app.get("/api/healthchecker")
@@ -28,6 +81,31 @@ def root():
     return {"message": "Welcome to Tafsiri, we are up and running"}
 
 
+@app.get("/api/readiness")
+def readiness():
+    """
+    Report ready only once the startup warm-up has finished
+    """
+    status = jsonable_encoder(warmup_state.as_dict())
+    if warmup_state.ready:
+        return status
+    return JSONResponse(status_code=503, content=status)
+
+
+@app.get("/api/metrics")
+def get_metrics():
+    return {"limits": {limiter.name: limiter.stats() for limiter in limiters}}
+
+
+@app.exception_handler(OverloadedError)
+async def overloaded_handler(request: Request, exc: OverloadedError):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 # Run the FastAPI application
 if __name__ == "__main__":
     import uvicorn
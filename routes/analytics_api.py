@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+
+from services.analytics import get_rollups, summarize_rollups
+
+router = APIRouter()
+
+# Default reporting window when no start date is given
+DEFAULT_WINDOW = timedelta(days=7)
+
+
+def to_local_naive(value):
+    """
+    Convert a timezone-aware datetime to naive local time, which is what created_at
+    and the rollup hours use
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+
+def get_window(start, end):
+    start, end = to_local_naive(start), to_local_naive(end)
+    end = end or datetime.now()
+    start = start or end - DEFAULT_WINDOW
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
+
+@router.get('/usage/hourly')
+def get_hourly_usage(start: Optional[datetime] = None, end: Optional[datetime] = None, config_id: Optional[str] = None):
+    """
+    Get hourly question counts, failure rates and latency percentiles
+    """
+    start, end = get_window(start, end)
+    rollups = get_rollups(start, end, config_id)
+    for rollup in rollups:
+        rollup.pop("latency_histogram", None)
+    return {"start": start, "end": end, "hours": rollups}
+
+
+@router.get('/usage/summary')
+def get_usage_summary(start: Optional[datetime] = None, end: Optional[datetime] = None, config_id: Optional[str] = None):
+    """
+    Get question counts, failure rate and latency percentiles for a period
+    """
+    start, end = get_window(start, end)
+    return {"start": start, "end": end, **summarize_rollups(get_rollups(start, end, config_id))}
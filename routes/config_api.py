@@ -2,6 +2,7 @@ from fastapi import APIRouter, HTTPException, Depends
 from database.schema import TafsiriConfigSchema
 from bson.objectid import ObjectId
 from database.database import get_mongo_collection, CONFIGS_COLLECTION
+from services.config_cache import get_cached_config, get_cached_configs, refresh_config, invalidate_config
 
 router = APIRouter()
 
@@ -15,12 +16,11 @@ def format_mongo_obj(obj):
 
 
 @router.get("/get_configs", response_model=list[TafsiriConfigSchema])
-async def get_configs(collection=Depends(lambda: get_mongo_collection(CONFIGS_COLLECTION))):
+async def get_configs():
     """
     Get all configurations for the Tafsiri API
     """
-    config_data = collection.find()
-    return [format_mongo_obj(config) for config in config_data]
+    return [format_mongo_obj(config) for config in get_cached_configs()]
 
 
 @router.post("/new_config", response_model=TafsiriConfigSchema)
@@ -31,6 +31,7 @@ async def create_new_config(config: TafsiriConfigSchema, collection=Depends(lamb
     config_data = config.model_dump(exclude_unset=True)
     result = collection.insert_one(config_data)
     if result.inserted_id:
+        refresh_config(result.inserted_id)
         return format_mongo_obj(config_data)
     raise HTTPException(
         status_code=400, detail="Configuration could not be created")
@@ -41,15 +42,12 @@ async def get_config(config_id):
     """
     Get a specific configuration for the Tafsiri API
     """
-    collection = get_mongo_collection(CONFIGS_COLLECTION)
-    if collection is None:
-        raise HTTPException(status_code=500, detail="Collection not found")
     try:
         config_id = ObjectId(config_id)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid config ID format")
 
-    config = collection.find_one({"_id": config_id})
+    config = get_cached_config(config_id)
     if config is None:
         raise HTTPException(status_code=404, detail="Config not found")
 
@@ -72,7 +70,7 @@ async def update_config(config_id: str, updated_config: TafsiriConfigSchema, col
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid config ID format")
 
-    config_data = collection.find_one({"_id": config_id})
+    config_data = get_cached_config(config_id)
     if config_data is None:
         raise HTTPException(status_code=404, detail="Config not found")
 
@@ -80,8 +78,11 @@ async def update_config(config_id: str, updated_config: TafsiriConfigSchema, col
     result = collection.update_one({"_id": config_id}, {"$set": updated_data})
 
     if result.modified_count == 1:
-        updated_config_data = collection.find_one({"_id": config_id})
-        return format_mongo_obj(updated_config_data)
+        updated_config_data = refresh_config(config_id)
+        # The config may have been deleted since it was updated
+        if updated_config_data is None:
+            raise HTTPException(status_code=404, detail="Config not found")
+        return format_mongo_obj(dict(updated_config_data))
 
     raise HTTPException(
         status_code=400, detail="Configuration could not be updated")
@@ -100,6 +101,7 @@ async def delete_config(config_id):
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid config ID format")
     result = collection.delete_one({"_id": config_id})
+    invalidate_config(config_id)
     if result.deleted_count == 1:
         return {"message": "Config deleted successfully"}
     raise HTTPException(status_code=404, detail="Config not found")
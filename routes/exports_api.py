@@ -0,0 +1,130 @@
+import os
+import re
+import logging
+from typing import Literal
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from pydantic import BaseModel
+
+from routes.tafsiriV2_api import get_config, pipeline
+from services.exports import (
+    EXPORT_FORMATS,
+    export_stage,
+    serialize_export,
+    get_export_path,
+)
+from services.jobs import submit_job
+from services.pipeline import QuestionRun
+
+log = logging.getLogger()
+
+router = APIRouter()
+
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+READ_BLOCK_SIZE = 64 * 1024
+
+export_pipelines = {
+    export_format: pipeline.replace("execute", export_stage(export_format))
+    .replace("serialize", serialize_export)
+    for export_format in EXPORT_FORMATS
+}
+
+
+def export_question(question, config, user_id, export_format):
+    """
+    Build the job function that exports a question's rows in the background
+    """
+    def work(report_progress):
+        run = QuestionRun(question, user_id, str(config["_id"]), config=config)
+        result = export_pipelines[export_format].run(
+            run, on_stage=report_progress)
+        if run.error is not None:
+            raise run.error
+        return result
+
+    return work
+
+
+def iter_file_range(path, start, length):
+    with open(path, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            block = file.read(min(READ_BLOCK_SIZE, length))
+            if not block:
+                return
+            length -= len(block)
+            yield block
+
+
+class NaturalLanguageExport(BaseModel):
+    question: str
+    user_id: str
+    config_id: str
+    format: Literal["csv", "parquet"] = "csv"
+
+
+@router.post('/question', status_code=202)
+def submit_export(nl_query: NaturalLanguageExport):
+    """
+    Queue an export of all rows answering a question to a compressed CSV or Parquet
+    file. Poll the job for the download URL.
+    """
+    config = get_config(nl_query.config_id)
+    job_id = submit_job(
+        "export",
+        export_question(nl_query.question, config,
+                        nl_query.user_id, nl_query.format),
+        question=nl_query.question,
+        config_id=nl_query.config_id,
+        created_by=nl_query.user_id,
+        format=nl_query.format,
+    )
+    return {"job_id": job_id, "status_url": f"/api/jobs/{job_id}", "result_url": f"/api/jobs/{job_id}/result"}
+
+
+@router.get('/files/{filename}')
+async def download_export(filename: str, request: Request):
+    """
+    Download an export file, supporting single byte ranges for resumable downloads
+    """
+    path = get_export_path(filename)
+    if path is None:
+        raise HTTPException(status_code=400, detail="Invalid export file name")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Export not found or expired")
+
+    media_type = next(export_format["media_type"] for export_format in EXPORT_FORMATS.values()
+                      if filename.endswith(export_format["extension"]))
+    range_header = request.headers.get("range")
+    if not range_header:
+        return FileResponse(path, media_type=media_type, filename=filename,
+                            headers={"Accept-Ranges": "bytes"})
+
+    size = os.path.getsize(path)
+    match = BYTE_RANGE.match(range_header.strip())
+    if match is None or match.groups() == ("", ""):
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range, the last N bytes
+        start = max(0, size - int(last))
+        end = size - 1
+    if start > end or start >= size:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    length = end - start + 1
+    return StreamingResponse(
+        iter_file_range(path, start, length),
+        status_code=206,
+        media_type=media_type,
+        headers={
+            "Accept-Ranges": "bytes",
+            "Content-Range": f"bytes {start}-{end}/{size}",
+            "Content-Length": str(length),
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        },
+    )
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+import logging
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from routes.tafsiriV2_api import get_config, pipeline
+from settings import settings
+from services.pipeline import QuestionRun
+from services.jobs import (
+    submit_job,
+    get_job,
+    format_job,
+    load_job_result,
+    is_stale,
+    JOB_COMPLETED,
+    TERMINAL_STATES,
+)
+
+log = logging.getLogger()
+
+router = APIRouter()
+
+# How often the event stream checks for job updates
+EVENT_POLL_INTERVAL = 1  # seconds
+
+
+def answer_question(question, config, user_id):
+    """
+    Build the job function that answers a question in the background
+    """
+    def work(report_progress):
+        run = QuestionRun(question, user_id, str(config["_id"]), config=config)
+        result = pipeline.run(run, on_stage=report_progress)
+        if run.error is not None:
+            raise run.error
+        return result
+
+    return work
+
+
+def get_job_or_404(job_id):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+class NaturalLanguageJobQuery(BaseModel):
+    question: str
+    user_id: str
+    config_id: str
+
+
+@router.post('/question', status_code=202)
+def submit_question_job(nl_query: NaturalLanguageJobQuery):
+    """
+    Queue a natural language question to be answered in the background
+    """
+    config = get_config(nl_query.config_id)
+    job_id = submit_job(
+        "question",
+        answer_question(nl_query.question, config, nl_query.user_id),
+        question=nl_query.question,
+        config_id=nl_query.config_id,
+        created_by=nl_query.user_id,
+    )
+    return {"job_id": job_id, "status": get_job(job_id)["status"]}
+
+
+@router.get('/{job_id}')
+def get_job_status(job_id: str):
+    """
+    Get the status and progress of a job
+    """
+    return format_job(get_job_or_404(job_id))
+
+
+@router.get('/{job_id}/events')
+async def stream_job_events(job_id: str, request: Request):
+    """
+    Stream job status changes as server-sent events until the job finishes.
+
+    The stream also ends when the client disconnects, when the job's worker stops
+    sending heartbeats, or after JOB_EVENTS_MAX_SECONDS.
+    """
+    await asyncio.to_thread(get_job_or_404, job_id)
+
+    async def events():
+        last_state = None
+        deadline = time.monotonic() + settings.JOB_EVENTS_MAX_SECONDS
+        while not await request.is_disconnected():
+            job = await asyncio.to_thread(get_job, job_id)
+            if job is None:
+                yield "event: expired\ndata: {}\n\n"
+                return
+            state = (job["status"], job.get("progress"))
+            payload = json.dumps(jsonable_encoder(format_job(job)))
+            if state != last_state:
+                last_state = state
+                yield f"event: status\ndata: {payload}\n\n"
+            if job["status"] in TERMINAL_STATES:
+                return
+            if is_stale(job):
+                yield f"event: stale\ndata: {payload}\n\n"
+                return
+            if time.monotonic() >= deadline:
+                yield f"event: timeout\ndata: {payload}\n\n"
+                return
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@router.get('/{job_id}/result')
+def get_job_result(job_id: str):
+    """
+    Get the result of a completed job
+    """
+    job = get_job_or_404(job_id)
+    if job["status"] != JOB_COMPLETED:
+        raise HTTPException(
+            status_code=409, detail=f"Job is {job['status']}, result not available")
+    try:
+        return load_job_result(job)
+    except Exception as e:
+        log.error(f"Error loading result for job {job_id}: {e}")
+        raise HTTPException(status_code=410, detail="Job result has expired") from e
@@ -1,14 +1,18 @@
+import asyncio
 import functools
+import json
 import os
 import requests
-import time
+import threading
 import logging
 
 from bson import ObjectId
 from fastapi import APIRouter, HTTPException
-from datetime import datetime
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
 from pydantic import BaseModel
-from sqlalchemy import Table, text
+from sqlalchemy import Table
 from llama_index.core import VectorStoreIndex
 from llama_index.core.objects import (
     ObjectIndex,
@@ -18,9 +22,18 @@ from llama_index.core.objects import (
 from llama_index.llms.openai import OpenAI
 from llama_index.legacy import SQLDatabase
 
-from database.schema import TafsiriResponsesBaseSchema
 from settings import settings
-from database.database import engine, SessionLocal, get_mongo_collection, metadata, TafsiriResp, CONFIGS_COLLECTION
+from database.database import engine, SessionLocal, metadata, TafsiriResp
+from services.config_cache import get_cached_config
+from services.limits import OverloadedError
+from services.pipeline import (
+    QuestionRun,
+    build_pipeline,
+    cached_stage,
+    generate,
+    execute,
+    build_run_response_data,
+)
 
 # Set up logging
 log = logging.getLogger()
@@ -103,11 +116,6 @@ def get_dictionary_info(tables, config_om_host, config_jwt_token):
     return tables_info
 
 
-# Step 3: Determine if the question requires the use of the second table
-def is_join_required(first_table_name):
-    return first_table_name in ["Linelist_FACTART", "LineListTransHTS", "LineListTransPNS", "LinelistHTSEligibilty"]
-
-
 @functools.lru_cache(maxsize=None)
 def get_dictionary_info_cached(tables, om_host, jwt_token):
     """
@@ -116,140 +124,214 @@ def get_dictionary_info_cached(tables, om_host, jwt_token):
     return get_dictionary_info(tables, om_host, jwt_token)
 
 
+def get_config(config_id):
+    """
+    Fetch a configuration document by id from the config cache, raising a 404 if it
+    does not exist
+    """
+    try:
+        config_id_obj = ObjectId(config_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid config ID format")
+    config = get_cached_config(config_id_obj)
+    if config is None:
+        raise HTTPException(status_code=404, detail="Config not found")
+    return config
+
+
+def load_config_context(run):
+    """
+    Pipeline stage that builds the SQL database wrapper and table retrieval index for
+    the run's configuration
+    """
+    config = run.config
+    # Set up SQL database
+    run.tables = config["tables"]
+    # Get custom prompt from config
+    run.custom_txt2sql_prompt = config["example_prompt"]
+
+    # store schema information for each table.
+    table_schema_objs = get_dictionary_info_cached(
+        tuple(run.tables), config["om_host"], config["om_jwt"])
+    # Create SQL database
+    run.sql_database = SQLDatabase(engine, include_tables=run.tables)
+    table_node_mapping = SQLTableNodeMapping(run.sql_database)
+
+    run.obj_index = ObjectIndex.from_objects(
+        table_schema_objs,
+        table_node_mapping,
+        VectorStoreIndex,
+    )
+
+
+def config_context_key(run):
+    """
+    Cache key covering every config field that load_config_context depends on
+    """
+    config = run.config
+    return (str(config["_id"]), tuple(config["tables"]), config["om_host"], config["om_jwt"], config["example_prompt"])
+
+
+pipeline = build_pipeline(cached_stage(
+    load_config_context, config_context_key,
+    outputs=("tables", "custom_txt2sql_prompt", "sql_database", "obj_index")))
+
+
+# Same as the question pipeline, but warm-up questions are not recorded
+warmup_pipeline = pipeline.replace("record", lambda run: None)
+
+
+def warm_up_config(config):
+    """
+    Load the dictionary and build the retrieval index for a config before the first
+    question
+    """
+    pipeline.get_stage("load_context")(
+        QuestionRun("", config_id=str(config["_id"]), config=config))
+
+
+def replay_question(config_id, question):
+    """
+    Answer a canned question end to end to warm the LLM client and connections
+    """
+    run = QuestionRun(question, config_id=config_id, config=get_config(config_id))
+    warmup_pipeline.run(run)
+    if run.error is not None:
+        raise run.error
+
+
 # Endpoint to retrieve data based on natural language query
 class NaturalLanguageQuery(BaseModel):
     question: str
     user_id: str
     config_id: str
+    # Overrides the SPECULATIVE_SQL setting for this question
+    speculative: Optional[bool] = None
 
 
 @router.post('/question')
-async def query_from_natural_language(nl_query: NaturalLanguageQuery):
+def query_from_natural_language(nl_query: NaturalLanguageQuery):
     """
     Endpoint to retrieve data based on natural language query from user
     """
-    start_time = time.time()
-    question = nl_query.question
-    # user_id = nl_query.user_id
-    config_id = nl_query.config_id
-
     # Fetch configuration details
-    collection = get_mongo_collection(CONFIGS_COLLECTION)
-    config_id_obj = ObjectId(config_id)
-    config = collection.find_one({"_id": config_id_obj})
-    if config is None:
-        raise HTTPException(status_code=404, detail="Config not found")
+    config = get_config(nl_query.config_id)
 
-    # Set up SQL database
-    tables = config["tables"]
+    return pipeline.run(QuestionRun(
+        nl_query.question, nl_query.user_id, nl_query.config_id,
+        speculative=nl_query.speculative, config=config))
 
-    # Get OM host and JWT
-    om_host = config["om_host"]
-    jwt_token = config["om_jwt"]
 
-    try:
-        # store schema information for each table.
-        table_schema_objs = get_dictionary_info_cached(
-            tuple(tables), om_host, jwt_token)
-        # Create SQL database
-        sql_database = SQLDatabase(engine, include_tables=tables)
-        table_node_mapping = SQLTableNodeMapping(sql_database)
-
-        obj_index = ObjectIndex.from_objects(
-            table_schema_objs,
-            table_node_mapping,
-            VectorStoreIndex,
-        )
+class BatchCancelledError(Exception):
+    """
+    Raised in questions of a batch whose client has disconnected
+    """
 
-    # Get custom prompt from config
-        custom_txt2sql_prompt = config["example_prompt"]
-
-        from llama_index.core.retrievers import NLSQLRetriever
-
-        # default retrieval (return_raw=True)
-        nl_sql_retriever = NLSQLRetriever(
-            sql_database,
-        )
-
-        # Retrieve objects dynamically with a maximum similarity_top_k value of 2
-        retriever = obj_index.as_retriever(similarity_top_k=2)
-        retrieved_objs = retriever.retrieve(question)
-
-        first_identified_table = retrieved_objs[0]
-        second_identified_table = retrieved_objs[1]
-
-        print("First Identified Table:", first_identified_table)
-        print("Second Identified Table:", second_identified_table)
-
-        custom_prompt_1 = (
-            "Please calculate proportion when asked to, generate sql query that contains both the numbers and proportion. Only output sql query, do not attempt to generate an answer"
-            f"You can refer to {custom_txt2sql_prompt} for examples and instructions on how to generate a SQL statement."
-            f"Write a SQL query to answer the following question: {question}, Using the table {first_identified_table}."
-            "Please take note of the column names which are in quotes and their description."
-        )
-        custom_prompt_2 = (
-            "Please calculate proportion when asked to, generate sql query that contains both the numbers and proportion. Only output sql query, do not attempt to generate an answer"
-            f"You can refer to {custom_txt2sql_prompt} for examples and instructions on how to generate a SQL statement. "
-            f"Write a SQL query to answer the following question: {question}, using the table {first_identified_table}. "
-            "Please take note of the column names which are in quotes and their description. Do not use the two tables if you are not merging, be careful to differentiate which column names are in which table."
-            f"If the question requires joining or merging, join with {second_identified_table} to retrieve the required variables."
-        )
-
-        first_table_name = first_identified_table.table_name
-        print(first_table_name)
-
-        # Check if the join is required
-        if is_join_required(first_table_name):
-            custom_prompt = custom_prompt_2
-            print("custom prompt 2 was used")
-        else:
-            custom_prompt = custom_prompt_1
-            print("custom prompt 1 was used")
-
-        # Generate SQL query
-        response = nl_sql_retriever.retrieve_with_metadata(custom_prompt)
-        response_list, metadata_dict = response
-        print(metadata_dict["sql_query"])
-
-        sql_query = metadata_dict["sql_query"]
-        log.debug(f"Generated SQL query: {sql_query}")
-        with SessionLocal() as session:
-            result = session.execute(text(sql_query))
-            rows = result.fetchall()
-            # Get column names
-            columns = result.keys()
-
-            data = [dict(zip(columns, row)) for row in rows]
-        end_time = time.time()  # Record the end time
-        time_taken = end_time - start_time  # Calculate the time taken
-        # Save metrics for analytics
-        response_data = {
-            "question": question,
-            "response": sql_query,
-            "time_taken_mms": time_taken,
-            "created_at": datetime.now(),
-        }
-        validated_data = TafsiriResponsesBaseSchema(
-            **response_data
-        )
-        saved_response = TafsiriResp.insert_one(validated_data.dict())
-
-        return {"sql_query": sql_query, "data": data, "time_taken": time_taken, "saved_response_id": str(saved_response.inserted_id)}
-    except Exception as e:
-        log.error(f"Error processing query: {e}")
+
+# Strong references to batch cleanups still running after their response has ended
+_batch_cleanups = set()
+
+
+class NaturalLanguageBatchQuery(BaseModel):
+    questions: List[str]
+    user_id: str
+    config_id: str
+
+
+@router.post('/questions/batch')
+async def batch_query_from_natural_language(batch_query: NaturalLanguageBatchQuery):
+    """
+    Endpoint to answer several questions for one configuration in a single request.
+
+    The dictionary and retrieval index are resolved once, SQL is generated concurrently
+    (bounded by BATCH_LLM_CONCURRENCY) and executed on one shared connection. Results are
+    streamed back as newline delimited JSON in the order they complete, and analytics are
+    written with a single insert once the batch is done.
+    """
+    if not batch_query.questions:
+        raise HTTPException(status_code=400, detail="No questions provided")
+    if len(batch_query.questions) > settings.BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {settings.BATCH_MAX_QUESTIONS} questions can be asked in a batch")
+
+    # Fetch configuration details
+    config = get_config(batch_query.config_id)
+
+    llm_semaphore = threading.Semaphore(settings.BATCH_LLM_CONCURRENCY)
+    # The shared connection can only run one statement at a time
+    session_lock = threading.Lock()
+    # Set when the client disconnects, so questions that have not started are skipped
+    stopped = threading.Event()
+    responses = []
+
+    def check_stopped():
+        if stopped.is_set():
+            raise BatchCancelledError("Batch was cancelled")
+
+    def bounded_generate(run):
+        with llm_semaphore:
+            check_stopped()
+            generate(run)
+
+    def locked_execute(run):
+        with session_lock:
+            check_stopped()
+            execute(run)
+
+    def collect_response(run):
+        if isinstance(run.error, BatchCancelledError):
+            return
+        build_run_response_data(run)
+        responses.append(run.response_data)
+
+    batch_pipeline = pipeline.replace("generate", bounded_generate) \
+        .replace("execute", locked_execute) \
+        .replace("record", collect_response)
+
+    async def answer_question(index, question, session):
+        # Speculative generation is lazy, so it would escape the batch's LLM bound
+        run = QuestionRun(question, batch_query.user_id, batch_query.config_id,
+                          speculative=False, session=session, config=config)
+        try:
+            result = await asyncio.to_thread(batch_pipeline.run, run)
+        except OverloadedError as e:
+            result = {"sql_query": None, "data": [], "time_taken": 0,
+                      "saved_response_id": None, "error": str(e)}
+        return {"index": index, "question": question, **result}
+
+    async def finish_batch(tasks, session):
+        # Cancelling a task does not stop its worker thread, so wait for every question
+        # to finish with the shared session before closing it and saving analytics
+        await asyncio.gather(*tasks, return_exceptions=True)
+        session.close()
         # Save metrics for analytics
-        response_data = {
-            "question": question,
-            "response": sql_query,
-            "time_taken_mms": 0,
-            "created_at": datetime.now(),
-            "is_valid": False
-        }
-        validated_data = TafsiriResponsesBaseSchema(
-            **response_data
-        )
-        saved_response = TafsiriResp.insert_one(validated_data.dict())
-        return {"sql_query": sql_query or None, "data": [], "time_taken": 0, "saved_response_id": str(saved_response.inserted_id)}
+        if responses:
+            try:
+                await asyncio.to_thread(TafsiriResp.insert_many, responses)
+            except Exception as e:
+                log.error(f"Error saving batch analytics: {e}")
+
+    async def stream_answers():
+        session = SessionLocal()
+        tasks = [asyncio.create_task(answer_question(index, question, session))
+                 for index, question in enumerate(batch_query.questions)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                yield json.dumps(jsonable_encoder(result)) + "\n"
+        finally:
+            stopped.set()
+            # Run the cleanup in its own task so it completes even when the response
+            # is cancelled by a client disconnect
+            cleanup = asyncio.create_task(finish_batch(tasks, session))
+            _batch_cleanups.add(cleanup)
+            cleanup.add_done_callback(_batch_cleanups.discard)
+            try:
+                await asyncio.shield(cleanup)
+            except asyncio.CancelledError:
+                pass
+
+    return StreamingResponse(stream_answers(), media_type="application/x-ndjson")
 
 
 # TODO: Implement the feedbck endpoints
@@ -1,15 +1,12 @@
-import csv
 import functools
 import os
 import requests
-import time
 import logging
 
 from bson import ObjectId
 from fastapi import APIRouter, HTTPException
-from datetime import datetime
 from pydantic import BaseModel
-from sqlalchemy import Table, text
+from sqlalchemy import Table
 from llama_index.core import VectorStoreIndex
 from llama_index.core.objects import (
     ObjectIndex,
@@ -19,9 +16,10 @@ from llama_index.core.objects import (
 from llama_index.llms.openai import OpenAI
 from llama_index.legacy import SQLDatabase
 
-from database.schema import TafsiriResponsesBaseSchema
 from settings import settings
-from database.database import engine, SessionLocal, metadata, client, TafsiriResp
+from services.dictionary import DictionaryLoader
+from services.pipeline import QuestionRun, build_pipeline, cached_stage
+from database.database import engine, metadata, client, TafsiriResp
 
 # Set up logging
 log = logging.getLogger()
@@ -45,87 +43,7 @@ tables = ["Linelist_FACTART", "LineListTransHTS", "LinelistPrep", "LinelistPrepA
 sql_database = SQLDatabase(engine, include_tables=tables)
 CACHE_TIMEOUT = 3600  # 1 hour
 
-
-def get_dictionary_info():
-    csv_path = 'dictionary/text2sql.csv'
-
-    table_descriptions = {}
-
-    with open(csv_path, mode='r') as file:
-        reader = csv.DictReader(file)
-
-        for row in reader:
-            parent_value = row['parent'].replace('text2sql.', '') if row['parent'] else None
-            if parent_value in tables or row['name'] in tables:
-                if not parent_value:
-                    table_name = row['name']
-                    table_description = row['description']
-                    table_descriptions[table_name] = {
-                        'description': table_description,
-                        'columns': {}
-                    }
-                else:
-                    table_name, column_name = parent_value, row['name']
-                    column_description = row['description']
-
-                    if table_name in table_descriptions:
-                        table_descriptions[table_name]['columns'][column_name] = column_description
-
-    tables_info = []
-    for table_name, data in table_descriptions.items():
-        table_description = data['description']
-        columns_info_list = [
-            f'"{col_name}": {col_desc}' for col_name, col_desc in data['columns'].items()
-        ]
-        columns_info = ". ".join(columns_info_list)
-
-        tables_info.append(
-            SQLTableSchema(
-                table_name=table_name,
-                context_str=(
-                    f'description of the table: {table_description}. '
-                    f'These are columns in the table and their descriptions: {columns_info}'
-                )
-            )
-        )
-    return tables_info
-
-
-# Step 3: Determine if the question requires the use of the second table
-def is_join_required(first_table_name):
-    return first_table_name in ["Linelist_FACTART", "LineListTransHTS", "LineListTransPNS", "LinelistHTSEligibilty"]
-
-
-@functools.lru_cache(maxsize=None)
-def get_dictionary_info_cached():
-    return get_dictionary_info()
-
-
-# Endpoint to retrieve data based on natural language query
-class NaturalLanguageQuery(BaseModel):
-    question: str
-    user_id: str
-
-
-@router.post('/query_from_natural_language')
-async def query_from_natural_language(nl_query: NaturalLanguageQuery):
-    start_time = time.time()
-    question = nl_query.question
-    user_id = nl_query.user_id
-    try:
-        # store schema information for each table.
-        table_schema_objs = get_dictionary_info_cached()
-        table_node_mapping = SQLTableNodeMapping(sql_database)
-
-        obj_index = ObjectIndex.from_objects(
-            table_schema_objs,
-            table_node_mapping,
-            VectorStoreIndex,
-        )
-
-        from llama_index.core.indices.struct_store import SQLTableRetrieverQueryEngine
-
-        custom_txt2sql_prompt = """Given an input question, construct a syntactically correct SQL query to run, then look at the results of the query and return a comprehensive and detailed answer. Ensure that you:
+custom_txt2sql_prompt = """Given an input question, construct a syntactically correct SQL query to run, then look at the results of the query and return a comprehensive and detailed answer. Ensure that you:
             - Select only the relevant columns needed to answer the question.
             - Use correct column and table names as provided in the schema description. Avoid querying for columns that do not exist.
             - Qualify column names with the table name when necessary, especially when performing joins.
@@ -218,92 +136,77 @@ async def query_from_natural_language(nl_query: NaturalLanguageQuery):
             SQLQUERY: SELECT County, COUNT(*) AS TotalTxCurr FROM Linelist_FACTART WHERE County IN (SELECT County FROM LineListTransHTS WHERE YEAR(TestDate) = 2023 GROUP BY County HAVING COUNT(*) > 10000) AND ISTxCurr = 1 GROUP BY County ORDER BY TotalTxCurr DESC;
 
         """
-        from llama_index.core.retrievers import NLSQLRetriever
 
-        # default retrieval (return_raw=True)
-        nl_sql_retriever = NLSQLRetriever(
-            sql_database,
+
+dictionary_loader = DictionaryLoader(
+    [settings.DICTIONARY_SOURCE], settings.DICTIONARY_ARTIFACT, settings.DICTIONARY_RELOAD_SECONDS)
+
+
+def get_dictionary_info(dictionary):
+    """
+    Build table schema objects for the configured tables from the compiled dictionary
+    """
+    table_set = set(tables)
+    return [
+        SQLTableSchema(
+            table_name=table_name,
+            context_str=dictionary.get_table(table_name)['context_str']
         )
+        for table_name in dictionary.table_names
+        if table_name in table_set
+    ]
 
-        # Retrieve objects dynamically with a maximum similarity_top_k value of 2
-        retriever = obj_index.as_retriever(similarity_top_k=2)
-        retrieved_objs = retriever.retrieve(question)
 
-        first_identified_table = retrieved_objs[0]
-        second_identified_table = retrieved_objs[1]
+@functools.lru_cache(maxsize=4)
+def _get_dictionary_info_for_version(version):
+    return get_dictionary_info(dictionary_loader.get())
 
-        print("First Identified Table:", first_identified_table)
-        print("Second Identified Table:", second_identified_table)
 
-        custom_prompt_1 = (
-            "Please calculate proportion when asked to, generate sql query that contains both the numbers and proportion. Only output sql query, do not attempt to generate an answer"
-            f"You can refer to {custom_txt2sql_prompt} for examples and instructions on how to generate a SQL statement."
-            f"Write a SQL query to answer the following question: {question}, Using the table {first_identified_table}."
-            "Please take note of the column names which are in quotes and their description."
-        )
-        custom_prompt_2 = (
-            "Please calculate proportion when asked to, generate sql query that contains both the numbers and proportion. Only output sql query, do not attempt to generate an answer"
-            f"You can refer to {custom_txt2sql_prompt} for examples and instructions on how to generate a SQL statement. "
-            f"Write a SQL query to answer the following question: {question}, using the table {first_identified_table}. "
-            "Please take note of the column names which are in quotes and their description. Do not use the two tables if you are not merging, be careful to differentiate which column names are in which table."
-            f"If the question requires joining or merging, join with {second_identified_table} to retrieve the required variables."
-        )
+def get_dictionary_info_cached():
+    # Keyed on the dictionary version so a recompiled dictionary is picked up
+    return _get_dictionary_info_for_version(dictionary_loader.get().version)
+
+
+def load_dictionary_context(run):
+    """
+    Pipeline stage that builds the table retrieval index from the compiled dictionary
+    """
+    run.tables = tables
+    run.custom_txt2sql_prompt = custom_txt2sql_prompt
+    run.sql_database = sql_database
+    # store schema information for each table.
+    table_schema_objs = get_dictionary_info_cached()
+    table_node_mapping = SQLTableNodeMapping(sql_database)
+
+    run.obj_index = ObjectIndex.from_objects(
+        table_schema_objs,
+        table_node_mapping,
+        VectorStoreIndex,
+    )
 
-        first_table_name = first_identified_table.table_name
-        print(first_table_name)
-
-        # Check if the join is required
-        if is_join_required(first_table_name):
-            custom_prompt = custom_prompt_2
-            print("custom prompt 2 was used")
-        else:
-            custom_prompt = custom_prompt_1
-            print("custom prompt 1 was used")
-
-        # Generate SQL query
-        response = nl_sql_retriever.retrieve_with_metadata(custom_prompt)
-        response_list, metadata_dict = response
-        print(metadata_dict["sql_query"])
-
-        sql_query = metadata_dict["sql_query"]
-        log.debug(f"Generated SQL query: {sql_query}")
-        with SessionLocal() as session:
-            result = session.execute(text(sql_query))
-            rows = result.fetchall()
-            # Get column names
-            columns = result.keys()
-
-            data = [dict(zip(columns, row)) for row in rows]
-        end_time = time.time()  # Record the end time
-        time_taken = end_time - start_time  # Calculate the time taken
-        # Save metrics for analytics
-        response_data = {
-            "question": question,
-            "response": sql_query,
-            "time_taken_mms": time_taken,
-            "created_at": datetime.now(),
-        }
-        validated_data = TafsiriResponsesBaseSchema(
-            **response_data
-        )
-        saved_response = TafsiriResp.insert_one(validated_data.dict())
 
-        return {"sql_query": sql_query, "data": data, "time_taken": time_taken, "saved_response_id": str(saved_response.inserted_id)}
-    except Exception as e:
-        log.error(f"Error processing query: {e}")
-        # Save metrics for analytics
-        response_data = {
-            "question": question,
-            "response": sql_query,
-            "time_taken_mms": 0,
-            "created_at": datetime.now(),
-            "is_valid": False
-        }
-        validated_data = TafsiriResponsesBaseSchema(
-            **response_data
-        )
-        saved_response = TafsiriResp.insert_one(validated_data.dict())
-        return {"sql_query": sql_query or None, "data": [], "time_taken": 0, "saved_response_id": str(saved_response.inserted_id)}
+# Rebuilt whenever the compiled dictionary changes
+pipeline = build_pipeline(cached_stage(
+    load_dictionary_context, lambda run: dictionary_loader.get().version,
+    outputs=("tables", "custom_txt2sql_prompt", "sql_database", "obj_index"), maxsize=2))
+
+
+def warm_up():
+    """
+    Load the dictionary and build the retrieval index before the first question
+    """
+    pipeline.get_stage("load_context")(QuestionRun(""))
+
+
+# Endpoint to retrieve data based on natural language query
+class NaturalLanguageQuery(BaseModel):
+    question: str
+    user_id: str
+
+
+@router.post('/query_from_natural_language')
+def query_from_natural_language(nl_query: NaturalLanguageQuery):
+    return pipeline.run(QuestionRun(nl_query.question, nl_query.user_id))
 
 
 class NaturalLanguageResponseRating(BaseModel):
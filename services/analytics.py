@@ -0,0 +1,227 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo.errors import BulkWriteError
+
+from settings import settings
+from database.database import mongo_db, TafsiriResp, TafsiriRespArchive, TafsiriRespRollups
+
+log = logging.getLogger()
+
+# Upper bounds (seconds) of the latency histogram buckets kept in each rollup
+LATENCY_BUCKETS = [0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120, 180, 300]
+ARCHIVE_BATCH_SIZE = 1000
+# Rollups are recomputed from this far before the latest one, to pick up late writes
+ROLLUP_OVERLAP = timedelta(hours=2)
+
+
+def ensure_analytics_indexes():
+    """
+    Create the indexes used by analytics queries, rollups and archival
+    """
+    TafsiriResp.create_index([("created_at", pymongo.ASCENDING)])
+    TafsiriResp.create_index([("is_valid", pymongo.ASCENDING)])
+    TafsiriResp.create_index([("response_rating", pymongo.ASCENDING)])
+    TafsiriResp.create_index(
+        [("config_id", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+    TafsiriResp.create_index(
+        [("created_by", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+    TafsiriRespRollups.create_index(
+        [("hour", pymongo.ASCENDING), ("config_id", pymongo.ASCENDING)], unique=True)
+    ensure_archive_ttl_index()
+
+
+def ensure_archive_ttl_index():
+    """
+    Create, update or drop the archive's TTL index to match
+    ANALYTICS_ARCHIVE_RETENTION_DAYS.
+
+    create_index cannot change the options of an existing index, so a changed
+    retention is applied with collMod instead.
+    """
+    expire_after = settings.ANALYTICS_ARCHIVE_RETENTION_DAYS * 86400
+    existing = next((
+        (name, index) for name, index in TafsiriRespArchive.index_information().items()
+        if index["key"] == [("created_at", pymongo.ASCENDING)]
+    ), None)
+
+    if existing is None:
+        if expire_after:
+            TafsiriRespArchive.create_index(
+                [("created_at", pymongo.ASCENDING)], expireAfterSeconds=expire_after)
+        return
+    name, index = existing
+    if not expire_after:
+        if "expireAfterSeconds" in index:
+            TafsiriRespArchive.drop_index(name)
+    elif index.get("expireAfterSeconds") != expire_after:
+        mongo_db.command({
+            "collMod": TafsiriRespArchive.name,
+            "index": {"name": name, "expireAfterSeconds": expire_after},
+        })
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def latency_histogram(latencies):
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    for latency in latencies:
+        histogram[bisect_left(LATENCY_BUCKETS, latency)] += 1
+    return histogram
+
+
+def histogram_percentile(histogram, fraction):
+    """
+    Estimate a percentile from a merged histogram, as the upper bound of its bucket
+    """
+    total = sum(histogram)
+    if total == 0:
+        return None
+    target = fraction * total
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= target:
+            return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def compute_hourly_rollups(since=None):
+    """
+    Aggregate responses into hourly counts, failure rates and latency percentiles.
+
+    Only hours from `since` onwards are recomputed; by default that is a little before
+    the most recent rollup, or everything when there are none yet.
+    """
+    if since is None:
+        latest = TafsiriRespRollups.find_one(sort=[("hour", pymongo.DESCENDING)])
+        since = latest["hour"] - ROLLUP_OVERLAP if latest else None
+
+    pipeline = []
+    if since is not None:
+        pipeline.append({"$match": {"created_at": {"$gte": since}}})
+    pipeline.append({"$group": {
+        "_id": {
+            "hour": {"$dateTrunc": {"date": "$created_at", "unit": "hour"}},
+            "config_id": "$config_id",
+        },
+        "count": {"$sum": 1},
+        "failures": {"$sum": {"$cond": [{"$eq": ["$is_valid", False]}, 1, 0]}},
+        "rated": {"$sum": {"$cond": [{"$ne": [{"$ifNull": ["$response_rating", None]}, None]}, 1, 0]}},
+        "average_rating": {"$avg": "$response_rating"},
+        "users": {"$addToSet": "$created_by"},
+        "latencies": {"$push": {"$cond": [{"$eq": ["$is_valid", False]}, "$$REMOVE", "$time_taken_mms"]}},
+    }})
+
+    updated = 0
+    for group in TafsiriResp.aggregate(pipeline, allowDiskUse=True):
+        latencies = sorted(group["latencies"])
+        rollup = {
+            "hour": group["_id"]["hour"],
+            "config_id": group["_id"]["config_id"],
+            "count": group["count"],
+            "failures": group["failures"],
+            "failure_rate": group["failures"] / group["count"],
+            "rated": group["rated"],
+            "average_rating": group["average_rating"],
+            "unique_users": len([user for user in group["users"] if user]),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p90": percentile(latencies, 0.9),
+            "latency_p99": percentile(latencies, 0.99),
+            "latency_histogram": latency_histogram(latencies),
+            "updated_at": datetime.now(),
+        }
+        TafsiriRespRollups.update_one(
+            {"hour": rollup["hour"], "config_id": rollup["config_id"]},
+            {"$set": rollup},
+            upsert=True,
+        )
+        updated += 1
+    return updated
+
+
+def archive_old_responses():
+    """
+    Move responses older than the retention window into the archive collection
+    """
+    if not settings.ANALYTICS_RETENTION_DAYS:
+        return 0
+    cutoff = datetime.now() - timedelta(days=settings.ANALYTICS_RETENTION_DAYS)
+    archived = 0
+    while True:
+        batch = list(TafsiriResp.find(
+            {"created_at": {"$lt": cutoff}}).limit(ARCHIVE_BATCH_SIZE))
+        if not batch:
+            return archived
+        try:
+            TafsiriRespArchive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Another worker may have archived some of these already
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        TafsiriResp.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        archived += len(batch)
+
+
+def get_rollups(start, end, config_id=None):
+    query = {"hour": {"$gte": start, "$lt": end}}
+    if config_id is not None:
+        query["config_id"] = config_id
+    return list(TafsiriRespRollups.find(query, {"_id": 0}).sort("hour", pymongo.ASCENDING))
+
+
+def summarize_rollups(rollups):
+    """
+    Combine hourly rollups into totals for the whole period
+    """
+    count = sum(rollup["count"] for rollup in rollups)
+    failures = sum(rollup["failures"] for rollup in rollups)
+    rated = sum(rollup["rated"] for rollup in rollups)
+    rating_total = sum((rollup["average_rating"] or 0) * rollup["rated"] for rollup in rollups)
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    for rollup in rollups:
+        histogram = [a + b for a, b in zip(histogram, rollup["latency_histogram"])]
+    return {
+        "count": count,
+        "failures": failures,
+        "failure_rate": failures / count if count else None,
+        "rated": rated,
+        "average_rating": rating_total / rated if rated else None,
+        "latency_p50": histogram_percentile(histogram, 0.5),
+        "latency_p90": histogram_percentile(histogram, 0.9),
+        "latency_p99": histogram_percentile(histogram, 0.99),
+        "latency_buckets": LATENCY_BUCKETS,
+        "latency_histogram": histogram,
+    }
+
+
+def run_analytics_maintenance():
+    updated = compute_hourly_rollups()
+    archived = archive_old_responses()
+    log.info(f"Analytics maintenance: {updated} rollups updated, {archived} responses archived")
+
+
+async def analytics_maintenance_loop():
+    """
+    Create the analytics indexes, then periodically refresh rollups and archive old
+    responses
+    """
+    try:
+        await asyncio.to_thread(ensure_analytics_indexes)
+    except Exception as e:
+        # Missing indexes slow analytics down but should not stop the API starting
+        log.error(f"Error creating analytics indexes: {e}")
+    while True:
+        try:
+            await asyncio.to_thread(run_analytics_maintenance)
+        except Exception as e:
+            log.error(f"Error running analytics maintenance: {e}")
+        await asyncio.sleep(settings.ANALYTICS_ROLLUP_INTERVAL_SECONDS)
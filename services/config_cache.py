@@ -0,0 +1,156 @@
+import threading
+import time
+import logging
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+from settings import settings
+from database.database import mongo_db, CONFIGS_COLLECTION
+
+log = logging.getLogger()
+
+# Server error codes for a deployment without change streams (not a replica set),
+# and for a resume token that has fallen off the oplog
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# Config documents keyed by their string id
+_configs = {}
+_lock = threading.Lock()
+_watcher = None
+
+
+def _collection():
+    return mongo_db[CONFIGS_COLLECTION]
+
+
+def load_configs():
+    """
+    Replace the cache contents with every config currently in MongoDB
+    """
+    configs = {str(config["_id"]): config for config in _collection().find()}
+    with _lock:
+        _configs.clear()
+        _configs.update(configs)
+    return len(configs)
+
+
+def refresh_config(config_id):
+    """
+    Reload a single config from MongoDB, dropping it if it no longer exists
+    """
+    config = _collection().find_one({"_id": ObjectId(config_id)})
+    with _lock:
+        if config is None:
+            _configs.pop(str(config_id), None)
+        else:
+            _configs[str(config_id)] = config
+    return config
+
+
+def invalidate_config(config_id):
+    with _lock:
+        _configs.pop(str(config_id), None)
+
+
+def get_cached_config(config_id):
+    """
+    Get a config by id, falling back to MongoDB on a cache miss.
+
+    Returns a copy so callers can modify it without touching the cache, or None if the
+    config does not exist.
+    """
+    with _lock:
+        config = _configs.get(str(config_id))
+    if config is None:
+        config = refresh_config(config_id)
+    return dict(config) if config is not None else None
+
+
+def get_cached_configs():
+    with _lock:
+        return [dict(config) for config in _configs.values()]
+
+
+def _apply_change(change):
+    config_id = str(change["documentKey"]["_id"])
+    if change["operationType"] == "delete":
+        invalidate_config(config_id)
+    elif change.get("fullDocument") is not None:
+        with _lock:
+            _configs[config_id] = change["fullDocument"]
+    else:
+        refresh_config(config_id)
+
+
+def _watch_changes():
+    """
+    Apply changes from a MongoDB change stream until the server reports that change
+    streams are unsupported.
+
+    The stream is reopened from its resume token after errors. Invalidate events
+    (the collection was dropped or renamed) and lost history reopen it from scratch,
+    reloading the whole collection so no change is missed.
+    """
+    resume_token = None
+    while True:
+        try:
+            with _collection().watch(
+                    full_document="updateLookup", resume_after=resume_token) as stream:
+                if resume_token is None:
+                    load_configs()
+                    log.info("Watching config changes with a change stream")
+                for change in stream:
+                    if change["operationType"] in ("insert", "update", "replace", "delete"):
+                        _apply_change(change)
+                    if change["operationType"] == "invalidate":
+                        resume_token = None
+                        break
+                    resume_token = stream.resume_token
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                log.warning(f"Config change streams unsupported, falling back to polling: {e}")
+                return
+            if e.code == CHANGE_STREAM_HISTORY_LOST:
+                log.warning(f"Config change stream history lost, reloading configs: {e}")
+                resume_token = None
+                continue
+            log.error(f"Error watching config changes, retrying: {e}")
+            time.sleep(settings.CONFIG_CACHE_POLL_SECONDS)
+        except PyMongoError as e:
+            log.error(f"Error watching config changes, retrying: {e}")
+            time.sleep(settings.CONFIG_CACHE_POLL_SECONDS)
+        except Exception as e:
+            log.exception(f"Unexpected error watching config changes, retrying: {e}")
+            time.sleep(settings.CONFIG_CACHE_POLL_SECONDS)
+
+
+def _watch_configs():
+    """
+    Keep the cache in sync with writes made by other workers.
+
+    Uses a MongoDB change stream where available (replica sets), otherwise reloads the
+    whole collection every CONFIG_CACHE_POLL_SECONDS.
+    """
+    _watch_changes()
+
+    while True:
+        time.sleep(settings.CONFIG_CACHE_POLL_SECONDS)
+        try:
+            load_configs()
+        except Exception as e:
+            log.error(f"Error reloading configs: {e}")
+
+
+def start_config_cache():
+    """
+    Populate the cache and start the background watcher if enabled
+    """
+    global _watcher
+    count = load_configs()
+    log.info(f"Loaded {count} configs into the cache")
+    if settings.CONFIG_CACHE_WATCH and _watcher is None:
+        _watcher = threading.Thread(
+            target=_watch_configs, name="tafsiri-config-watcher", daemon=True)
+        _watcher.start()
@@ -0,0 +1,256 @@
+"""
+Compiled data dictionary.
+
+The glossary CSV (an OpenMetadata glossary export such as dictionary/text2sql.csv) is
+compiled into a single binary artifact holding every table, its columns, synonyms and
+the context string handed to the retriever. The artifact is memory-mapped, so workers
+on the same host share one copy of it in the page cache and only decode the tables they
+look up.
+
+Artifact layout:
+    8 bytes   magic (b"TFSDICT1")
+    4 bytes   format version (uint32, little endian)
+    4 bytes   index length (uint32, little endian)
+    n bytes   index, JSON: source fingerprint, synonyms and table name -> (offset, length)
+    ...       table records, JSON, addressed relative to the end of the index
+
+Compile from the command line with:
+    python -m services.dictionary dictionary/text2sql.csv -o dictionary/text2sql.dict
+"""
+import argparse
+import csv
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+from datetime import datetime
+
+log = logging.getLogger()
+
+MAGIC = b"TFSDICT1"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sII")
+
+# Prefix OpenMetadata adds to the parent of glossary terms in the text2sql glossary
+GLOSSARY_PREFIX = "text2sql."
+
+
+def build_context_str(table_description, columns):
+    columns_info = ". ".join(
+        f'"{col_name}": {col_desc}' for col_name, col_desc in columns.items()
+    )
+    return (
+        f'description of the table: {table_description}. '
+        f'These are columns in the table and their descriptions: {columns_info}'
+    )
+
+
+def _split_synonyms(value):
+    return [synonym.strip() for synonym in (value or "").split(";") if synonym.strip()]
+
+
+def parse_glossary(paths):
+    """
+    Read one or more glossary CSV exports into table records.
+
+    Tables are collected before columns, so rows may appear in any order.
+    """
+    rows = []
+    for path in paths:
+        with open(path, mode='r', encoding='utf-8') as file:
+            rows.extend(csv.DictReader(file))
+
+    tables = {}
+    for row in rows:
+        if not row['parent']:
+            tables[row['name']] = {
+                'name': row['name'],
+                'description': row['description'],
+                'synonyms': _split_synonyms(row.get('synonyms')),
+                'columns': {},
+                'column_synonyms': {},
+            }
+
+    for row in rows:
+        if not row['parent']:
+            continue
+        table_name = row['parent'].replace(GLOSSARY_PREFIX, '')
+        if table_name not in tables:
+            log.warning(
+                f"Skipping column {row['name']}: unknown table {table_name}")
+            continue
+        tables[table_name]['columns'][row['name']] = row['description']
+        synonyms = _split_synonyms(row.get('synonyms'))
+        if synonyms:
+            tables[table_name]['column_synonyms'][row['name']] = synonyms
+
+    for table in tables.values():
+        table['context_str'] = build_context_str(
+            table['description'], table['columns'])
+    return tables
+
+
+def fingerprint(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def compile_dictionary(sources, artifact_path):
+    """
+    Compile glossary CSV files into a dictionary artifact.
+
+    The artifact is written to a temporary file and moved into place, so workers that
+    already have the old version mapped keep reading it safely.
+    """
+    tables = parse_glossary(sources)
+
+    records = []
+    table_index = {}
+    offset = 0
+    for name, table in tables.items():
+        record = json.dumps(table, ensure_ascii=False).encode('utf-8')
+        table_index[name] = [offset, len(record)]
+        records.append(record)
+        offset += len(record)
+
+    synonyms = {}
+    for name, table in tables.items():
+        for synonym in table['synonyms']:
+            synonyms[synonym.lower()] = name
+
+    index = json.dumps({
+        'sources': [os.path.abspath(source) for source in sources],
+        'source_sha256': fingerprint(sources),
+        'compiled_at': datetime.now().isoformat(),
+        'tables': table_index,
+        'synonyms': synonyms,
+    }).encode('utf-8')
+
+    tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index)))
+        file.write(index)
+        for record in records:
+            file.write(record)
+    os.replace(tmp_path, artifact_path)
+    return len(tables)
+
+
+class CompiledDictionary:
+    """
+    Read-only, memory-mapped view of a dictionary artifact
+    """
+
+    def __init__(self, artifact_path):
+        with open(artifact_path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._mmap.close()
+            raise ValueError(
+                f"{artifact_path} is not a version {FORMAT_VERSION} dictionary artifact")
+        self._data_start = HEADER.size + index_length
+        index = json.loads(self._mmap[HEADER.size:self._data_start])
+        self.sources = index['sources']
+        self.source_sha256 = index['source_sha256']
+        self.compiled_at = index['compiled_at']
+        self.synonyms = index['synonyms']
+        self._tables = index['tables']
+
+    @property
+    def version(self):
+        return self.source_sha256
+
+    @property
+    def table_names(self):
+        return list(self._tables)
+
+    def __contains__(self, table_name):
+        return table_name in self._tables
+
+    def get_table(self, table_name):
+        entry = self._tables.get(table_name)
+        if entry is None:
+            return None
+        start = self._data_start + entry[0]
+        return json.loads(self._mmap[start:start + entry[1]])
+
+    def resolve_table(self, name):
+        """
+        Find a table by its name or one of its synonyms
+        """
+        if name in self._tables:
+            return name
+        return self.synonyms.get(name.lower())
+
+    def close(self):
+        self._mmap.close()
+
+
+class DictionaryLoader:
+    """
+    Keep a compiled dictionary loaded, recompiling it when the source files change.
+
+    Source files are checked at most once every `reload_interval` seconds.
+    """
+
+    def __init__(self, sources, artifact_path, reload_interval=5):
+        self.sources = list(sources)
+        self.artifact_path = artifact_path
+        self.reload_interval = reload_interval
+        self._dictionary = None
+        self._source_mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _sources_mtime(self):
+        return max(os.path.getmtime(source) for source in self.sources)
+
+    def _load(self):
+        source_mtime = self._sources_mtime()
+        stale = (not os.path.exists(self.artifact_path)
+                 or os.path.getmtime(self.artifact_path) < source_mtime)
+        dictionary = None
+        if not stale:
+            try:
+                dictionary = CompiledDictionary(self.artifact_path)
+            except ValueError as e:
+                log.warning(f"Recompiling dictionary: {e}")
+        if dictionary is None or dictionary.source_sha256 != fingerprint(self.sources):
+            if dictionary is not None:
+                dictionary.close()
+            count = compile_dictionary(self.sources, self.artifact_path)
+            log.info(
+                f"Compiled {count} tables into {self.artifact_path}")
+            dictionary = CompiledDictionary(self.artifact_path)
+        # Old mappings are left to the garbage collector so in-flight readers keep working
+        self._dictionary = dictionary
+        self._source_mtime = source_mtime
+
+    def get(self):
+        now = time.monotonic()
+        if self._dictionary is not None and now - self._checked_at < self.reload_interval:
+            return self._dictionary
+        with self._lock:
+            if self._dictionary is None or self._sources_mtime() != self._source_mtime:
+                self._load()
+            self._checked_at = now
+        return self._dictionary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compile glossary CSV exports into a dictionary artifact")
+    parser.add_argument("sources", nargs="+", help="Glossary CSV files")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Path of the artifact to write")
+    args = parser.parse_args()
+    table_count = compile_dictionary(args.sources, args.output)
+    print(f"Compiled {table_count} tables into {args.output}")
@@ -0,0 +1,220 @@
+import asyncio
+import csv
+import gzip
+import os
+import re
+import secrets
+import time
+import logging
+
+from sqlalchemy import text
+
+from settings import settings
+from services.limits import sql_limiter
+from services.pipeline import try_candidates
+
+log = logging.getLogger()
+
+EXPORT_FORMATS = {
+    "csv": {"extension": "csv.gz", "media_type": "application/gzip"},
+    "parquet": {"extension": "parquet", "media_type": "application/vnd.apache.parquet"},
+}
+# Minimum scale of decimal columns in Parquet exports. MSSQL gives computed
+# proportions such as x * 100.0 / COUNT(*) a scale of around 12.
+PARQUET_MIN_DECIMAL_SCALE = 18
+# Export files are served without authentication, so their names must be unguessable
+EXPORT_TOKEN_BYTES = 24
+EXPORT_FILENAME = re.compile(r'^[A-Za-z0-9_-]{32}\.(csv\.gz|parquet)$')
+
+
+def get_export_path(filename):
+    """
+    Resolve an export file name to its path, or None if the name is not a valid export
+    """
+    if not EXPORT_FILENAME.match(filename):
+        return None
+    return os.path.join(settings.EXPORT_DIR, filename)
+
+
+def iter_chunks(session, sql_query):
+    """
+    Run a query and yield its column names followed by lists of at most
+    EXPORT_CHUNK_SIZE rows, without loading the whole result into memory
+    """
+    result = session.execute(
+        text(sql_query).execution_options(stream_results=True))
+    try:
+        yield list(result.keys())
+        while True:
+            rows = result.fetchmany(settings.EXPORT_CHUNK_SIZE)
+            if not rows:
+                return
+            yield rows
+    finally:
+        result.close()
+
+
+def write_csv(path, chunks):
+    columns = next(chunks)
+    row_count = 0
+    with gzip.open(path, "wt", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+            row_count += len(rows)
+    return row_count
+
+
+def parquet_schema(table):
+    """
+    Fix the export schema from the first chunk.
+
+    Decimal precision and scale are inferred from the values in a chunk, so decimals
+    are widened to the maximum precision, keeping their scale but at least
+    PARQUET_MIN_DECIMAL_SCALE, to hold the values of later chunks. Columns that are
+    empty in the first chunk have no type yet and are written as strings.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for field in table.schema:
+        if pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        elif pa.types.is_decimal(field.type):
+            scale = min(max(field.type.scale, PARQUET_MIN_DECIMAL_SCALE), 38)
+            field = field.with_type(pa.decimal128(38, scale))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def cast_chunk(table, schema):
+    """
+    Cast a chunk to the export schema.
+
+    A safe cast raises rather than truncating values that do not fit. When a decimal
+    has more places than the schema's scale, it is rounded to that scale instead of
+    failing the export.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    try:
+        return table.cast(schema, safe=True)
+    except pa.ArrowInvalid:
+        columns = []
+        for column, field in zip(table.columns, schema):
+            if pa.types.is_decimal(column.type) and pa.types.is_decimal(field.type) \
+                    and column.type.scale > field.type.scale:
+                log.warning(
+                    f"Rounding export column {field.name} to {field.type.scale} decimal places")
+                column = pc.round(column, ndigits=field.type.scale)
+            columns.append(column)
+        return pa.Table.from_arrays(columns, schema=table.schema).cast(schema, safe=True)
+
+
+def write_parquet(path, chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = next(chunks)
+    row_count = 0
+    writer = None
+    try:
+        for rows in chunks:
+            table = pa.Table.from_pylist([dict(zip(columns, row)) for row in rows])
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    path, parquet_schema(table), compression="zstd")
+            writer.write_table(cast_chunk(table, writer.schema))
+            row_count += len(rows)
+        if writer is None:
+            writer = pq.ParquetWriter(
+                path, pa.schema([(column, pa.string()) for column in columns]))
+    finally:
+        if writer is not None:
+            writer.close()
+    return row_count
+
+
+WRITERS = {"csv": write_csv, "parquet": write_parquet}
+
+
+def write_export(session, sql_query, export_format, path):
+    """
+    Stream the rows of a query into an export file, returning the number of rows.
+
+    Rows are written to a temporary file that replaces `path` once complete.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with sql_limiter.limit():
+            row_count = WRITERS[export_format](
+                tmp_path, iter_chunks(session, sql_query))
+        os.replace(tmp_path, path)
+    except Exception:
+        session.rollback()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return row_count
+
+
+def export_stage(export_format):
+    """
+    Build a pipeline stage that writes the query's rows to a file instead of returning
+    them
+    """
+    def export(run):
+        os.makedirs(settings.EXPORT_DIR, exist_ok=True)
+        # Stored with the job result, which is the only place the download URL appears
+        token = secrets.token_urlsafe(EXPORT_TOKEN_BYTES)
+        filename = f"{token}.{EXPORT_FORMATS[export_format]['extension']}"
+        path = os.path.join(settings.EXPORT_DIR, filename)
+
+        def write_rows(session, sql_query):
+            row_count = write_export(session, sql_query, export_format, path)
+            run.export = {
+                "format": export_format,
+                "filename": filename,
+                "rows": row_count,
+                "size_bytes": os.path.getsize(path),
+                "download_url": f"/api/exports/files/{filename}",
+            }
+
+        try_candidates(run, write_rows)
+
+    return export
+
+
+def serialize_export(run):
+    run.result = {"sql_query": run.sql_query, "export": run.export, "time_taken": run.time_taken,
+                  "saved_response_id": str(run.response_id), "timings": run.timings}
+
+
+def purge_expired_exports():
+    """
+    Remove export files older than the retention window
+    """
+    if not os.path.isdir(settings.EXPORT_DIR):
+        return
+    cutoff = time.time() - settings.EXPORT_RETENTION_SECONDS
+    for filename in os.listdir(settings.EXPORT_DIR):
+        path = os.path.join(settings.EXPORT_DIR, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError as e:
+            log.error(f"Failed to remove export {path}: {e}")
+
+
+async def export_cleanup_loop():
+    """
+    Periodically remove expired export files
+    """
+    while True:
+        try:
+            await asyncio.to_thread(purge_expired_exports)
+        except Exception as e:
+            log.error(f"Error purging exports: {e}")
+        await asyncio.sleep(settings.EXPORT_PURGE_INTERVAL_SECONDS)
@@ -0,0 +1,259 @@
+import gzip
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import gridfs
+import pymongo
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from settings import settings
+from database.database import mongo_db, TafsiriJobs
+from services.limits import patient_admission
+
+log = logging.getLogger()
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+TERMINAL_STATES = (JOB_COMPLETED, JOB_FAILED)
+
+# Worker pool for long running questions, sized independently of the web server
+executor = ThreadPoolExecutor(
+    max_workers=settings.JOB_WORKERS, thread_name_prefix="tafsiri-job")
+
+# Identifies the process that owns a job, so jobs left behind by a dead worker can be found
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# Ids of this worker's unfinished jobs, kept alive by the heartbeat thread
+_active_jobs = set()
+_active_lock = threading.Lock()
+_heartbeat = None
+
+
+class GridFSResultStore:
+    """
+    Keep job results in MongoDB GridFS so every web worker can read them
+    """
+
+    def __init__(self):
+        self.fs = gridfs.GridFS(mongo_db, collection="tafsiri_job_results")
+
+    def save(self, job_id, payload):
+        return str(self.fs.put(payload, filename=job_id))
+
+    def load(self, ref):
+        return self.fs.get(ObjectId(ref)).read()
+
+    def delete(self, ref):
+        self.fs.delete(ObjectId(ref))
+
+
+class LocalResultStore:
+    """
+    Keep job results as files on local disk
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, job_id, payload):
+        path = os.path.join(self.directory, f"{job_id}.json.gz")
+        with open(path, "wb") as file:
+            file.write(payload)
+        return path
+
+    def load(self, ref):
+        with open(ref, "rb") as file:
+            return file.read()
+
+    def delete(self, ref):
+        if os.path.exists(ref):
+            os.remove(ref)
+
+
+def get_result_store():
+    if settings.JOB_RESULT_STORE == "local":
+        return LocalResultStore(settings.JOB_RESULT_DIR)
+    return GridFSResultStore()
+
+
+result_store = get_result_store()
+
+
+def update_job(job_id, **fields):
+    fields["updated_at"] = datetime.now()
+    TafsiriJobs.update_one({"_id": job_id}, {"$set": fields})
+
+
+def get_job(job_id):
+    """
+    Get a job by id, or None if it does not exist or its retention window has passed
+    """
+    return TafsiriJobs.find_one({"_id": job_id, "expires_at": {"$gt": datetime.now()}})
+
+
+def format_job(job):
+    """
+    Shape a job document for API responses, leaving out internal fields
+    """
+    return {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "progress": job.get("progress"),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+        "expires_at": job.get("expires_at"),
+    }
+
+
+def is_stale(job):
+    """
+    Whether an unfinished job's worker has stopped sending heartbeats
+    """
+    if job["status"] in TERMINAL_STATES:
+        return False
+    heartbeat_at = job.get("heartbeat_at") or job.get("updated_at")
+    cutoff = datetime.now() - timedelta(seconds=settings.JOB_STALE_SECONDS)
+    return heartbeat_at is None or heartbeat_at < cutoff
+
+
+def fail_stale_jobs():
+    """
+    Mark unfinished jobs failed when their worker has stopped sending heartbeats,
+    e.g. because it was restarted or crashed
+    """
+    now = datetime.now()
+    cutoff = now - timedelta(seconds=settings.JOB_STALE_SECONDS)
+    result = TafsiriJobs.update_many(
+        {
+            "status": {"$nin": list(TERMINAL_STATES)},
+            "$or": [
+                {"heartbeat_at": {"$lt": cutoff}},
+                # Jobs queued before heartbeats were recorded
+                {"heartbeat_at": {"$exists": False}, "updated_at": {"$lt": cutoff}},
+            ],
+        },
+        {"$set": {
+            "status": JOB_FAILED,
+            "progress": "failed",
+            "error": "Job was abandoned by its worker",
+            "updated_at": now,
+        }},
+    )
+    if result.modified_count:
+        log.warning(f"Marked {result.modified_count} abandoned jobs failed")
+    return result.modified_count
+
+
+def _send_heartbeats():
+    while True:
+        time.sleep(settings.JOB_HEARTBEAT_SECONDS)
+        try:
+            with _active_lock:
+                job_ids = list(_active_jobs)
+            if job_ids:
+                TafsiriJobs.update_many(
+                    {"_id": {"$in": job_ids}}, {"$set": {"heartbeat_at": datetime.now()}})
+            fail_stale_jobs()
+            purge_expired_jobs()
+        except Exception as e:
+            log.error(f"Error sending job heartbeats: {e}")
+
+
+def ensure_job_indexes():
+    TafsiriJobs.create_index([("expires_at", pymongo.ASCENDING)])
+    TafsiriJobs.create_index(
+        [("status", pymongo.ASCENDING), ("heartbeat_at", pymongo.ASCENDING)])
+
+
+def start_job_heartbeat():
+    """
+    Fail jobs abandoned by earlier workers and start heartbeating this worker's jobs.
+
+    The heartbeat thread also fails stale jobs and purges expired ones as it goes.
+    """
+    global _heartbeat
+    ensure_job_indexes()
+    fail_stale_jobs()
+    if _heartbeat is None:
+        _heartbeat = threading.Thread(
+            target=_send_heartbeats, name="tafsiri-job-heartbeat", daemon=True)
+        _heartbeat.start()
+
+
+def load_job_result(job):
+    return json.loads(gzip.decompress(result_store.load(job["result_ref"])))
+
+
+def purge_expired_jobs():
+    """
+    Remove jobs whose retention window has passed, along with their stored results
+    """
+    for job in TafsiriJobs.find({"expires_at": {"$lte": datetime.now()}}):
+        if job.get("result_ref"):
+            try:
+                result_store.delete(job["result_ref"])
+            except Exception as e:
+                log.error(f"Failed to delete result for job {job['_id']}: {e}")
+        TafsiriJobs.delete_one({"_id": job["_id"]})
+
+
+def run_job(job_id, work):
+    """
+    Run a job function on the worker pool, recording progress and the final result.
+
+    `work` receives a callback that it can use to report its current stage.
+    """
+    def report_progress(stage):
+        update_job(job_id, status=JOB_RUNNING, progress=stage)
+
+    try:
+        # Jobs wait for LLM and database capacity instead of failing as overloaded
+        with patient_admission(settings.JOB_QUEUE_TIMEOUT_SECONDS):
+            result = work(report_progress)
+        report_progress("storing_result")
+        payload = gzip.compress(json.dumps(jsonable_encoder(result)).encode())
+        result_ref = result_store.save(job_id, payload)
+        update_job(job_id, status=JOB_COMPLETED,
+                   progress="completed", result_ref=result_ref)
+    except Exception as e:
+        log.error(f"Job {job_id} failed: {e}")
+        update_job(job_id, status=JOB_FAILED, progress="failed", error=str(e))
+    finally:
+        with _active_lock:
+            _active_jobs.discard(job_id)
+
+
+def submit_job(kind, work, **details):
+    """
+    Queue a job on the worker pool and return its id
+    """
+    job_id = uuid.uuid4().hex
+    now = datetime.now()
+    TafsiriJobs.insert_one({
+        "_id": job_id,
+        "kind": kind,
+        "status": JOB_QUEUED,
+        "progress": JOB_QUEUED,
+        "created_at": now,
+        "updated_at": now,
+        "heartbeat_at": now,
+        "worker_id": WORKER_ID,
+        "expires_at": now + timedelta(seconds=settings.JOB_RESULT_TTL_SECONDS),
+        **details,
+    })
+    with _active_lock:
+        _active_jobs.add(job_id)
+    executor.submit(run_job, job_id, work)
+    return job_id
@@ -0,0 +1,193 @@
+import math
+import random
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import openai
+
+from settings import settings
+
+log = logging.getLogger()
+
+# Per-thread admission overrides, see patient_admission()
+_admission = threading.local()
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a call is shed because its limiter is saturated
+    """
+
+    def __init__(self, limiter_name, status_code, retry_after, reason):
+        super().__init__(f"{limiter_name} is overloaded: {reason}")
+        self.limiter_name = limiter_name
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """
+    Bound the number of concurrent calls to a backend, with a bounded wait queue.
+
+    Calls are rejected straight away when the queue is full or when the wait predicted
+    from recent call durations is longer than the queue timeout, and rejected after
+    waiting when the queue timeout passes. Safe to use from any thread.
+    """
+
+    def __init__(self, name, concurrency, queue_size, queue_timeout, status_code):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.status_code = status_code
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        # Exponentially weighted average of how long a call holds a slot
+        self._average_duration = None
+        self._stats = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_predicted_wait": 0,
+            "rejected_timeout": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    def _predicted_wait(self):
+        if self._average_duration is None or self._in_flight < self.concurrency:
+            return 0
+        return (self._waiting + 1) * self._average_duration / self.concurrency
+
+    def _retry_after(self):
+        return max(1, math.ceil(self._predicted_wait() or self.queue_timeout))
+
+    def _reject(self, stat, reason):
+        self._stats[stat] += 1
+        raise OverloadedError(self.name, self.status_code,
+                              self._retry_after(), reason)
+
+    def _admit(self, queued_at):
+        self._in_flight += 1
+        waited = time.monotonic() - queued_at
+        self._stats["admitted"] += 1
+        self._stats["total_wait_seconds"] += waited
+        self._stats["max_wait_seconds"] = max(
+            self._stats["max_wait_seconds"], waited)
+        return time.monotonic()
+
+    def acquire(self):
+        """
+        Wait for a call slot, returning the time it was admitted
+        """
+        patient_timeout = getattr(_admission, "queue_timeout", None)
+        queued_at = time.monotonic()
+        with self._condition:
+            if self._in_flight >= self.concurrency:
+                if patient_timeout is None:
+                    if self._waiting >= self.queue_size:
+                        self._reject("rejected_queue_full", "queue is full")
+                    if self._predicted_wait() > self.queue_timeout:
+                        self._reject("rejected_predicted_wait",
+                                     "predicted wait exceeds queue timeout")
+                deadline = queued_at + (self.queue_timeout if patient_timeout is None
+                                        else patient_timeout)
+                self._waiting += 1
+                try:
+                    while self._in_flight >= self.concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("rejected_timeout",
+                                         "timed out waiting in queue")
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            return self._admit(queued_at)
+
+    def try_acquire(self):
+        """
+        Take a call slot only if one is free right now and nobody is queued for it,
+        returning the time it was admitted or None
+        """
+        with self._condition:
+            if self._in_flight >= self.concurrency or self._waiting:
+                return None
+            return self._admit(time.monotonic())
+
+    def release(self, started_at):
+        duration = time.monotonic() - started_at
+        with self._condition:
+            self._in_flight -= 1
+            self._average_duration = duration if self._average_duration is None \
+                else 0.8 * self._average_duration + 0.2 * duration
+            self._condition.notify()
+
+    @contextmanager
+    def limit(self):
+        started_at = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started_at)
+
+    def stats(self):
+        with self._condition:
+            admitted = self._stats["admitted"]
+            return {
+                "concurrency": self.concurrency,
+                "queue_size": self.queue_size,
+                "in_flight": self._in_flight,
+                "queue_depth": self._waiting,
+                "average_wait_seconds": self._stats["total_wait_seconds"] / admitted if admitted else 0,
+                "average_duration_seconds": self._average_duration,
+                **self._stats,
+            }
+
+
+@contextmanager
+def patient_admission(queue_timeout):
+    """
+    Make limiter calls on this thread wait up to `queue_timeout` seconds for a slot.
+
+    Meant for background work, which should queue behind interactive requests rather
+    than be shed: the queue size and predicted wait checks are skipped, and only the
+    longer deadline can reject a call.
+    """
+    previous = getattr(_admission, "queue_timeout", None)
+    _admission.queue_timeout = queue_timeout
+    try:
+        yield
+    finally:
+        _admission.queue_timeout = previous
+
+
+def retry_with_backoff(fn, *args, retry_on=(openai.RateLimitError,), **kwargs):
+    """
+    Call `fn`, retrying with exponential backoff and full jitter on rate limit errors
+    """
+    for attempt in range(settings.LLM_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except retry_on as e:
+            if attempt == settings.LLM_MAX_RETRIES:
+                raise
+            delay = random.uniform(
+                0, settings.LLM_RETRY_BASE_SECONDS * 2 ** attempt)
+            log.warning(
+                f"Rate limited ({e}), retrying in {delay:.1f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+
+
+# Limiter for LLM generation, shed with 429 since the provider is the bottleneck
+llm_limiter = AdmissionLimiter(
+    "llm", settings.LLM_CONCURRENCY, settings.LLM_QUEUE_SIZE,
+    settings.LLM_QUEUE_TIMEOUT_SECONDS, status_code=429)
+
+# Limiter for queries against the reporting database
+sql_limiter = AdmissionLimiter(
+    "sql", settings.SQL_CONCURRENCY, settings.SQL_QUEUE_SIZE,
+    settings.SQL_QUEUE_TIMEOUT_SECONDS, status_code=503)
+
+limiters = [llm_limiter, sql_limiter]
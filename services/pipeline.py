@@ -0,0 +1,498 @@
+"""
+Question pipeline shared by the v1 and v2 routers.
+
+A question runs through these stages in order:
+    load_context -> route_tables -> build_prompt -> generate -> validate -> execute
+followed by serialize -> record, which always run so failures are reported and counted.
+
+Each stage is a function that reads and updates a QuestionRun. Routers build a pipeline
+with their own load_context stage and may swap any other stage with `replace`; stages
+can be wrapped with `cached_stage` to reuse their outputs between questions. The time
+spent in every stage is kept on the run.
+
+Generation is lazy when speculative mode is on, so the time spent waiting for the LLM
+is counted against the execute stage in that case.
+"""
+import threading
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from bson import ObjectId
+from sqlalchemy import text
+
+from database.schema import TafsiriResponsesBaseSchema
+from database.database import SessionLocal, TafsiriResp
+from settings import settings
+from services.limits import llm_limiter, sql_limiter, retry_with_backoff, OverloadedError
+from services.sql_validation import validate_sql_query
+
+log = logging.getLogger()
+
+# Runs candidate prompts in parallel for speculative SQL generation
+speculation_executor = ThreadPoolExecutor(
+    max_workers=settings.LLM_CONCURRENCY, thread_name_prefix="tafsiri-speculation")
+
+
+class QuestionRun:
+    """
+    State of one question as it moves through the pipeline
+    """
+
+    def __init__(self, question, user_id=None, config_id=None, speculative=None, session=None, config=None):
+        self.question = question
+        self.user_id = user_id
+        self.config_id = config_id
+        # Router specific settings for load_context, such as a config document
+        self.config = config
+        self.speculative = settings.SPECULATIVE_SQL if speculative is None else speculative
+        # Shared session to execute on, a new one is opened per question when unset
+        self.session = session
+        # Assigned up front so the id can be returned before the analytics write
+        self.response_id = ObjectId()
+        self.start_time = time.time()
+        self.time_taken = 0
+
+        # Set by load_context
+        self.tables = None
+        self.custom_txt2sql_prompt = None
+        self.sql_database = None
+        self.obj_index = None
+        # Set by route_tables
+        self.retrieved_tables = None
+        # Set by build_prompt
+        self.prompts = None
+        self.default_prompt = None
+        # Set by generate and validate, an iterable of candidate SQL queries
+        self.candidates = None
+        # Set by execute
+        self.sql_query = None
+        self.data = []
+        # Set by export pipelines instead of data
+        self.export = None
+        # Set by serialize and record
+        self.result = None
+        self.response_data = None
+
+        self.error = None
+        self.timings = {}
+        self.cache_hits = []
+
+
+class Pipeline:
+    """
+    An ordered set of named stages that answers a question
+    """
+
+    def __init__(self, stages, final_stages):
+        self.stages = list(stages)
+        self.final_stages = list(final_stages)
+
+    def replace(self, name, stage):
+        """
+        Return a copy of the pipeline with the stage called `name` swapped out
+        """
+        def swap(stages):
+            return [(stage_name, stage if stage_name == name else current)
+                    for stage_name, current in stages]
+        names = [stage_name for stage_name, _ in self.stages + self.final_stages]
+        if name not in names:
+            raise KeyError(f"Unknown pipeline stage {name}")
+        return Pipeline(swap(self.stages), swap(self.final_stages))
+
+    def get_stage(self, name):
+        for stage_name, stage in self.stages + self.final_stages:
+            if stage_name == name:
+                return stage
+        raise KeyError(f"Unknown pipeline stage {name}")
+
+    def _run_stage(self, name, stage, run, on_stage):
+        if on_stage is not None:
+            on_stage(name)
+        started = time.perf_counter()
+        try:
+            stage(run)
+        finally:
+            run.timings[name] = time.perf_counter() - started
+
+    def run(self, run, on_stage=None):
+        """
+        Run every stage on a question and return its serialized result.
+
+        Overload errors are raised to the caller without being recorded; any other
+        error is recorded as a failed response.
+        """
+        try:
+            for name, stage in self.stages:
+                self._run_stage(name, stage, run, on_stage)
+        except OverloadedError:
+            raise
+        except Exception as e:
+            log.error(f"Error processing query: {e}")
+            run.error = e
+        run.time_taken = 0 if run.error else time.time() - run.start_time
+        for name, stage in self.final_stages:
+            self._run_stage(name, stage, run, on_stage)
+        log.debug(f"Stage timings: {run.timings}")
+        return run.result
+
+
+def cached_stage(stage, key, outputs, maxsize=32):
+    """
+    Wrap a stage so its outputs are reused for runs with the same cache key.
+
+    `key` maps a run to a hashable key and `outputs` names the run attributes the stage
+    sets. Concurrent runs with the same key wait for the first one instead of
+    repeating the work.
+    """
+    cache = OrderedDict()
+    lock = threading.Lock()
+    # Per-key locks with the number of runs holding or waiting on them, removed once
+    # no run uses them so failing keys do not accumulate
+    key_locks = {}
+
+    def run_stage(run, cache_key):
+        with lock:
+            values = cache.get(cache_key)
+            if values is not None:
+                cache.move_to_end(cache_key)
+        if values is None:
+            stage(run)
+            values = tuple(getattr(run, output) for output in outputs)
+            with lock:
+                cache[cache_key] = values
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return
+        for output, value in zip(outputs, values):
+            setattr(run, output, value)
+        run.cache_hits.append(getattr(stage, "__name__", str(stage)))
+
+    def run_cached(run):
+        cache_key = key(run)
+        with lock:
+            entry = key_locks.setdefault(cache_key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                run_stage(run, cache_key)
+        finally:
+            with lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del key_locks[cache_key]
+
+    return run_cached
+
+
+# Step 3: Determine if the question requires the use of the second table
+def is_join_required(first_table_name):
+    return first_table_name in ["Linelist_FACTART", "LineListTransHTS", "LineListTransPNS", "LinelistHTSEligibilty"]
+
+
+def build_single_table_prompt(question, custom_txt2sql_prompt, table):
+    return (
+        "Please calculate proportion when asked to, generate sql query that contains both the numbers and proportion. Only output sql query, do not attempt to generate an answer"
+        f"You can refer to {custom_txt2sql_prompt} for examples and instructions on how to generate a SQL statement."
+        f"Write a SQL query to answer the following question: {question}, Using the table {table}."
+        "Please take note of the column names which are in quotes and their description."
+    )
+
+
+def build_join_prompt(question, custom_txt2sql_prompt, first_table, second_table):
+    return (
+        "Please calculate proportion when asked to, generate sql query that contains both the numbers and proportion. Only output sql query, do not attempt to generate an answer"
+        f"You can refer to {custom_txt2sql_prompt} for examples and instructions on how to generate a SQL statement. "
+        f"Write a SQL query to answer the following question: {question}, using the table {first_table}. "
+        "Please take note of the column names which are in quotes and their description. Do not use the two tables if you are not merging, be careful to differentiate which column names are in which table."
+        f"If the question requires joining or merging, join with {second_table} to retrieve the required variables."
+    )
+
+
+def generate_sql(sql_database, prompt):
+    """
+    Ask the LLM to turn a prompt into a SQL query, without admission control
+    """
+    from llama_index.core.retrievers import NLSQLRetriever
+
+    # Only generate the SQL, it is validated and executed by later stages
+    nl_sql_retriever = NLSQLRetriever(
+        sql_database,
+        sql_only=True,
+    )
+
+    response = retry_with_backoff(
+        nl_sql_retriever.retrieve_with_metadata, prompt)
+    response_list, metadata_dict = response
+
+    sql_query = metadata_dict["sql_query"]
+    log.debug(f"Generated SQL query: {sql_query}")
+    return sql_query
+
+
+def run_sql_prompt(sql_database, prompt):
+    """
+    Ask the LLM to turn a prompt into a SQL query
+    """
+    with llm_limiter.limit():
+        return generate_sql(sql_database, prompt)
+
+
+def execute_sql_query(session, sql_query):
+    """
+    Run a generated SQL query and return the rows as a list of dicts
+    """
+    try:
+        with sql_limiter.limit():
+            result = session.execute(text(sql_query))
+            rows = result.fetchall()
+        # Get column names
+        columns = result.keys()
+    except Exception:
+        # Leave the session usable for the next query
+        session.rollback()
+        raise
+
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def build_response_data(question, sql_query, time_taken, config_id, created_by, is_valid=True):
+    """
+    Build a validated analytics document for a question
+    """
+    response_data = {
+        "question": question,
+        "response": sql_query,
+        "time_taken_mms": time_taken,
+        "created_at": datetime.now(),
+        "created_by": created_by,
+        "config_id": config_id,
+        "is_valid": is_valid
+    }
+    validated_data = TafsiriResponsesBaseSchema(
+        **response_data
+    )
+    return validated_data.dict()
+
+
+def route_tables(run):
+    """
+    Retrieve the tables most relevant to the question
+    """
+    top_k = max(2, settings.SPECULATIVE_TOP_K) if run.speculative else 2
+    retriever = run.obj_index.as_retriever(similarity_top_k=top_k)
+    run.retrieved_tables = retriever.retrieve(run.question)
+    log.debug(f"Identified tables: {[table.table_name for table in run.retrieved_tables]}")
+
+
+def build_prompt(run):
+    """
+    Build the join prompt and the single-table prompts, and pick the default one.
+
+    Outside speculative mode only the first table gets a single-table prompt.
+    """
+    first_identified_table = run.retrieved_tables[0]
+    second_identified_table = run.retrieved_tables[1]
+
+    run.prompts = {"join": build_join_prompt(
+        run.question, run.custom_txt2sql_prompt, first_identified_table, second_identified_table)}
+    single_tables = run.retrieved_tables[:settings.SPECULATIVE_TOP_K] if run.speculative \
+        else [first_identified_table]
+    for table in single_tables:
+        run.prompts[f"single:{table.table_name}"] = build_single_table_prompt(
+            run.question, run.custom_txt2sql_prompt, table)
+
+    # Check if the join is required
+    run.default_prompt = "join" if is_join_required(first_identified_table.table_name) \
+        else f"single:{first_identified_table.table_name}"
+    log.debug(f"Default prompt: {run.default_prompt}")
+
+
+def generate_speculatively(sql_database, prompts, default_prompt):
+    """
+    Generate SQL for several prompts at once, returning a generator of
+    (name, sql_query) in the order they finish.
+
+    The default prompt waits for an LLM slot like any other request. The other
+    prompts only run when a slot is free straight away, so speculation uses spare
+    capacity without queueing behind, or ahead of, other requests. Closing the
+    generator cancels prompts that have not started. Calls already in flight cannot
+    be interrupted, their results are discarded.
+    """
+    admitted = [(default_prompt, llm_limiter.acquire())]
+    for name in prompts:
+        if name == default_prompt:
+            continue
+        started_at = llm_limiter.try_acquire()
+        if started_at is None:
+            break
+        admitted.append((name, started_at))
+
+    futures = {}
+    try:
+        for name, started_at in admitted:
+            future = speculation_executor.submit(generate_sql, sql_database, prompts[name])
+            futures[future] = name
+            # Each call gives its slot back as soon as it finishes or is cancelled
+            future.add_done_callback(
+                lambda _, started_at=started_at: llm_limiter.release(started_at))
+    except Exception:
+        for name, started_at in admitted[len(futures):]:
+            llm_limiter.release(started_at)
+        for future in futures:
+            future.cancel()
+        raise
+
+    def candidates():
+        last_error = None
+        generated = False
+        try:
+            for future in as_completed(futures):
+                try:
+                    sql_query = future.result()
+                except Exception as e:
+                    log.error(f"Error generating {futures[future]} candidate: {e}")
+                    last_error = e
+                    continue
+                generated = True
+                yield futures[future], sql_query
+            if not generated and last_error is not None:
+                raise last_error
+        finally:
+            for future in futures:
+                future.cancel()
+
+    return candidates()
+
+
+def close_candidates(candidates):
+    """
+    Stop a lazy candidate generator so pending generation is cancelled
+    """
+    close = getattr(candidates, "close", None)
+    if close is not None:
+        close()
+
+
+def generate(run):
+    """
+    Generate candidate SQL queries as (prompt name, sql_query) pairs
+    """
+    if run.speculative:
+        run.candidates = generate_speculatively(
+            run.sql_database, run.prompts, run.default_prompt)
+    else:
+        run.candidates = [(run.default_prompt, run_sql_prompt(
+            run.sql_database, run.prompts[run.default_prompt]))]
+
+
+def validate(run):
+    """
+    Keep the candidates that pass validation against the cached schema.
+
+    The default prompt's candidate is kept as a last resort even if it fails
+    validation, so validation never makes a question fail that would otherwise run.
+    """
+    candidates = run.candidates
+
+    def valid_candidates():
+        fallback = None
+        generated = iter(candidates)
+        try:
+            for name, sql_query in generated:
+                problems = validate_sql_query(sql_query, run.tables)
+                if not problems:
+                    log.debug(f"Using {name} candidate")
+                    yield sql_query
+                    continue
+                log.debug(f"Rejected {name} candidate: {'; '.join(problems)}")
+                if name == run.default_prompt:
+                    fallback = sql_query
+        finally:
+            close_candidates(generated)
+        if fallback is not None:
+            yield fallback
+
+    run.candidates = valid_candidates()
+
+
+def try_candidates(run, execute_candidate):
+    """
+    Call `execute_candidate(session, sql_query)` on the validated candidates in turn
+    until one succeeds
+    """
+    last_error = None
+    candidates = iter(run.candidates)
+    try:
+        for sql_query in candidates:
+            run.sql_query = sql_query
+            try:
+                if run.session is not None:
+                    execute_candidate(run.session, sql_query)
+                else:
+                    with SessionLocal() as session:
+                        execute_candidate(session, sql_query)
+                return
+            except OverloadedError:
+                raise
+            except Exception as e:
+                log.error(f"Error executing candidate query: {e}")
+                last_error = e
+    finally:
+        close_candidates(candidates)
+    if last_error is not None:
+        raise last_error
+    raise ValueError("No SQL query could be generated")
+
+
+def execute(run):
+    """
+    Run the validated candidate queries in turn until one executes
+    """
+    def fetch_rows(session, sql_query):
+        run.data = execute_sql_query(session, sql_query)
+
+    try_candidates(run, fetch_rows)
+
+
+def serialize(run):
+    if run.error is not None:
+        run.data = []
+    run.result = {"sql_query": run.sql_query, "data": run.data, "time_taken": run.time_taken,
+                  "saved_response_id": str(run.response_id), "timings": run.timings}
+
+
+def build_run_response_data(run):
+    run.response_data = {"_id": run.response_id, **build_response_data(
+        run.question, run.sql_query, run.time_taken, run.config_id, run.user_id,
+        is_valid=run.error is None)}
+
+
+def record(run):
+    """
+    Save metrics for analytics
+    """
+    build_run_response_data(run)
+    TafsiriResp.insert_one(run.response_data)
+
+
+def build_pipeline(load_context):
+    """
+    Build the default pipeline around a router specific load_context stage
+    """
+    return Pipeline(
+        stages=[
+            ("load_context", load_context),
+            ("route_tables", route_tables),
+            ("build_prompt", build_prompt),
+            ("generate", generate),
+            ("validate", validate),
+            ("execute", execute),
+        ],
+        final_stages=[
+            ("serialize", serialize),
+            ("record", record),
+        ],
+    )
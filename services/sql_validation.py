@@ -0,0 +1,97 @@
+import re
+
+from database.database import metadata
+
+# Words that can appear unquoted in generated T-SQL without being column names
+SQL_KEYWORDS = {
+    "select", "distinct", "top", "percent", "from", "where", "and", "or", "not", "in", "is",
+    "null", "as", "on", "join", "inner", "left", "right", "full", "outer", "cross", "apply",
+    "group", "by", "order", "asc", "desc", "having", "union", "all", "intersect", "except",
+    "case", "when", "then", "else", "end", "between", "like", "exists", "with", "over",
+    "partition", "rows", "range", "unbounded", "preceding", "following", "current", "row",
+    "offset", "fetch", "next", "only", "cast", "convert", "varchar", "nvarchar", "char",
+    "int", "bigint", "float", "decimal", "numeric", "date", "datetime", "bit", "true",
+    "false", "year", "quarter", "month", "week", "day", "dayofyear", "hour", "minute",
+    "second", "yy", "yyyy", "qq", "q", "mm", "m", "wk", "ww", "dd", "d", "dy", "y", "hh",
+    "mi", "n", "ss", "s", "getdate", "current_timestamp", "ties", "collate", "nulls",
+    "first", "last", "within", "pivot", "unpivot", "for", "values", "escape",
+}
+
+IDENTIFIER = r'(?:\[[^\]]+\]|"[^"]+"|[A-Za-z_]\w*)'
+TABLE_REFERENCE = re.compile(
+    rf'\b(?:FROM|JOIN)\s+((?:{IDENTIFIER}\s*\.\s*)*)({IDENTIFIER})(?:\s+(?:AS\s+)?({IDENTIFIER}))?',
+    re.IGNORECASE)
+CTE_NAME = re.compile(rf'(?:\bWITH|,)\s*({IDENTIFIER})\s+AS\s*\(', re.IGNORECASE)
+ALIAS = re.compile(rf'\bAS\s+({IDENTIFIER})', re.IGNORECASE)
+DERIVED_TABLE_ALIAS = re.compile(rf'\)\s*({IDENTIFIER})', re.IGNORECASE)
+STRING_LITERAL = re.compile(r"N?'(?:[^']|'')*'")
+TOKEN = re.compile(rf'({IDENTIFIER})(\s*\.\s*({IDENTIFIER}))?(\s*\()?')
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+
+
+def _unquote(identifier):
+    if identifier[0] in '["':
+        identifier = identifier[1:-1]
+    return identifier.lower()
+
+
+def get_table_columns(table_name):
+    """
+    Get the lowercased column names of a table from the reflected schema
+    """
+    for name, table in metadata.tables.items():
+        if name.lower() == table_name.lower() or table.name.lower() == table_name.lower():
+            return {column.lower() for column in table.columns.keys()}
+    return None
+
+
+def validate_sql_query(sql_query, tables):
+    """
+    Cheaply check a generated query against the cached schema without running it.
+
+    Returns a list of problems, empty when the query looks valid. Only read queries
+    over the allowed tables with known column names pass.
+    """
+    if not sql_query:
+        return ["no SQL query was generated"]
+    sql = STRING_LITERAL.sub("''", sql_query.strip().rstrip(';'))
+    if not re.match(r'^\s*(SELECT|WITH)\b', sql, re.IGNORECASE):
+        return ["query is not a SELECT statement"]
+
+    allowed_tables = {table.lower() for table in tables}
+    cte_names = {_unquote(name) for name in CTE_NAME.findall(sql)}
+    aliases = {_unquote(alias) for alias in ALIAS.findall(sql)}
+    aliases |= {_unquote(alias) for alias in DERIVED_TABLE_ALIAS.findall(sql)
+                if _unquote(alias) not in SQL_KEYWORDS}
+
+    problems = []
+    columns = set()
+    table_names = set()
+    for _, table, alias in TABLE_REFERENCE.findall(sql):
+        table_name = _unquote(table)
+        if alias and _unquote(alias) not in SQL_KEYWORDS:
+            aliases.add(_unquote(alias))
+        if table_name in cte_names:
+            continue
+        if table_name not in allowed_tables:
+            problems.append(f"table {table_name} is not available")
+            continue
+        table_columns = get_table_columns(table_name)
+        if table_columns is None:
+            problems.append(f"table {table_name} is not in the schema")
+            continue
+        table_names.add(table_name)
+        columns |= table_columns
+    if problems:
+        return problems
+
+    known = columns | aliases | table_names | cte_names
+    for first, qualified, second, call in TOKEN.findall(NUMBER.sub(" ", sql)):
+        if call:
+            # Function calls and derived table definitions
+            continue
+        name = _unquote(second) if qualified else _unquote(first)
+        if name in SQL_KEYWORDS or name in known:
+            continue
+        problems.append(f"column {name} does not exist")
+    return problems
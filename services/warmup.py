@@ -0,0 +1,125 @@
+import asyncio
+import json
+import time
+import logging
+from datetime import datetime
+
+from sqlalchemy import text
+
+from settings import settings
+from database.database import client, engine
+
+log = logging.getLogger()
+
+
+class WarmupState:
+    """
+    Progress of the startup warm-up, reported by the readiness endpoint
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.stage = "pending"
+        self.started_at = None
+        self.completed_at = None
+        self.completed_steps = []
+        self.failed_steps = {}
+
+    def as_dict(self):
+        return {
+            "ready": self.ready,
+            "stage": self.stage,
+            "started_at": self.started_at,
+            "completed_at": self.completed_at,
+            "completed_steps": self.completed_steps,
+            "failed_steps": self.failed_steps,
+        }
+
+
+warmup_state = WarmupState()
+
+
+def ping_mongo():
+    client.admin.command("ping")
+
+
+def prefill_sql_pool():
+    """
+    Open pooled connections to the reporting database so the first queries reuse them
+    """
+    size = min(settings.WARMUP_SQL_CONNECTIONS, engine.pool.size())
+    connections = []
+    try:
+        for _ in range(size):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.execute(text("SELECT 1"))
+    finally:
+        # Closing returns the connections to the pool
+        for connection in connections:
+            connection.close()
+
+
+def load_warmup_questions():
+    """
+    Read the canned questions to replay, a JSON list of {"config_id", "question"}
+    """
+    if not settings.WARMUP_QUESTIONS_FILE:
+        return []
+    try:
+        with open(settings.WARMUP_QUESTIONS_FILE, mode='r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        log.error(f"Could not read warm-up questions: {e}")
+        return []
+
+
+async def _run_step(name, step, semaphore):
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(step)
+        except Exception as e:
+            log.error(f"Warm-up step {name} failed: {e}")
+            warmup_state.failed_steps[name] = str(e)
+            return False
+        log.info(f"Warm-up step {name} took {time.perf_counter() - started:.1f}s")
+        warmup_state.completed_steps.append(name)
+        return True
+
+
+async def _run_stage(stage, steps, semaphore):
+    warmup_state.stage = stage
+    results = await asyncio.gather(
+        *(_run_step(name, step, semaphore) for name, step in steps))
+    return all(results)
+
+
+async def run_warmup(connection_steps, load_context_steps, load_question_steps):
+    """
+    Connect to the backends, warm retrieval contexts and optionally canned questions,
+    then mark the worker ready.
+
+    Connection steps must all succeed, and are retried every WARMUP_RETRY_SECONDS
+    until they do; they also run when WARMUP_ENABLED is off. Context and question
+    steps are only built once connected, run concurrently, and a failure is reported
+    without holding back readiness, so one broken config cannot keep the worker out
+    of rotation.
+    """
+    warmup_state.started_at = datetime.now()
+    semaphore = asyncio.Semaphore(settings.WARMUP_CONCURRENCY)
+
+    while not await _run_stage("connections", connection_steps, semaphore):
+        await asyncio.sleep(settings.WARMUP_RETRY_SECONDS)
+        warmup_state.failed_steps.clear()
+        warmup_state.completed_steps.clear()
+
+    if settings.WARMUP_ENABLED:
+        await _run_stage("contexts", load_context_steps(), semaphore)
+        await _run_stage("questions", load_question_steps(), semaphore)
+
+    warmup_state.stage = "complete" if settings.WARMUP_ENABLED else "disabled"
+    warmup_state.completed_at = datetime.now()
+    warmup_state.ready = True
+    log.info(
+        f"Warm-up complete in {(warmup_state.completed_at - warmup_state.started_at).total_seconds():.1f}s")
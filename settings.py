@@ -14,6 +14,68 @@ class Settings(BaseSettings):
     OM_HOST: str
     OM_JWT: str
 
+    # Maximum number of concurrent LLM calls, and of questions, for a batch of questions
+    BATCH_LLM_CONCURRENCY: int = 4
+    BATCH_MAX_QUESTIONS: int = 100
+
+    # Background jobs for long running questions
+    JOB_WORKERS: int = 2
+    JOB_RESULT_STORE: str = "gridfs"  # "gridfs" or "local"
+    JOB_RESULT_DIR: str = "job_results"
+    JOB_RESULT_TTL_SECONDS: int = 86400
+    # Unfinished jobs whose worker stops heartbeating for this long are marked failed
+    JOB_HEARTBEAT_SECONDS: int = 15
+    JOB_STALE_SECONDS: int = 120
+    JOB_EVENTS_MAX_SECONDS: int = 3600
+    # How long a job waits for LLM or database capacity before failing
+    JOB_QUEUE_TIMEOUT_SECONDS: float = 600
+
+    # Config cache, kept in sync across workers with a change stream or polling
+    CONFIG_CACHE_WATCH: bool = True
+    CONFIG_CACHE_POLL_SECONDS: int = 30
+
+    # Compiled data dictionary, rebuilt when the source CSV changes
+    DICTIONARY_SOURCE: str = "dictionary/text2sql.csv"
+    DICTIONARY_ARTIFACT: str = "dictionary/text2sql.dict"
+    DICTIONARY_RELOAD_SECONDS: int = 5
+
+    # Analytics rollups and retention. Archival is off by default; set
+    # ANALYTICS_RETENTION_DAYS to move older responses to tafsiri_responses_archive
+    # (they can no longer be rated once archived), and ANALYTICS_ARCHIVE_RETENTION_DAYS
+    # to expire archived responses. 0 keeps them forever.
+    ANALYTICS_ROLLUP_INTERVAL_SECONDS: int = 300
+    ANALYTICS_RETENTION_DAYS: int = 0
+    ANALYTICS_ARCHIVE_RETENTION_DAYS: int = 0
+
+    # Admission control for LLM generation and reporting database queries
+    LLM_CONCURRENCY: int = 8
+    LLM_QUEUE_SIZE: int = 32
+    LLM_QUEUE_TIMEOUT_SECONDS: float = 30
+    LLM_MAX_RETRIES: int = 3
+    LLM_RETRY_BASE_SECONDS: float = 1
+    SQL_CONCURRENCY: int = 4
+    SQL_QUEUE_SIZE: int = 32
+    SQL_QUEUE_TIMEOUT_SECONDS: float = 30
+
+    # Generate SQL for several prompt variants at once and run the first valid one
+    SPECULATIVE_SQL: bool = False
+    SPECULATIVE_TOP_K: int = 2
+
+    # Large result exports to compressed CSV or Parquet files
+    EXPORT_DIR: str = "exports"
+    EXPORT_CHUNK_SIZE: int = 10000
+    EXPORT_RETENTION_SECONDS: int = 86400
+    EXPORT_PURGE_INTERVAL_SECONDS: int = 300
+
+    # Startup warm-up, /api/readiness reports ready once it completes. Connecting to
+    # MongoDB and the reporting database is always awaited, disabling only skips
+    # warming contexts and questions.
+    WARMUP_ENABLED: bool = True
+    WARMUP_CONCURRENCY: int = 4
+    WARMUP_SQL_CONNECTIONS: int = 5
+    WARMUP_RETRY_SECONDS: int = 10
+    WARMUP_QUESTIONS_FILE: str = ""
+
     class Config:
         env_file = './.env'
         extra = 'ignore'